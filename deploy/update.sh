@@ -1,8 +1,29 @@
 #!/usr/bin/env bash
 
-# Recommended: Use /shutdown alfred before committing. May cause some funky issues with voiceclients.
-killall -9 python3
+# Cogs that can be reloaded in place (SIGUSR1) without dropping voice connections.
+# Anything else changing (main.py, helper modules, requirements) needs a restart.
+reloadable='^src/(commands|music|acnh|stats)\.py$'
+
+old=$(git rev-parse HEAD)
 git pull
+changed=$(git diff --name-only "$old" HEAD)
 cd ..
+
+if [ -z "$changed" ]; then
+    exit 0
+fi
+if ! echo "$changed" | grep -qvE "$reloadable"; then
+    # launcher.py passes it on to its workers, whose command lines don't mention either script
+    pkill -USR1 -f 'main\.py|launcher\.py'
+    exit 0
+fi
+
+# SIGTERM lets the bot save what's playing (it resumes after the restart). Only force it if it hangs.
+killall python3
+for i in $(seq 1 15); do
+    pgrep python3 > /dev/null || break
+    sleep 1
+done
+killall -9 python3 2> /dev/null
 pip3 install -r requirements.txt
 ./start.sh
@@ -1,99 +1,44 @@
-import re
+import time
 
+import configloader as cfload
 import discord
-import mwparserfromhell as mwp
-import requests
 from discord.ext import commands
+from fishdata import FishIndex, FishStore
 
 
-# Use https://www.mediawiki.org/wiki/API:Revisions#Sample_Code to GET from https://animalcrossing.fandom.com/wiki/Fish_(New_Horizons)
-
 class ACNH(commands.Cog):
     """ Various helper commands for Animal Crossing: New Horizons game on the Nintendo Switch. """
 
-    fish_url = 'https://animalcrossing.fandom.com/api.php?action=query&prop=revisions&rvprop=content&rvslots=*&format=json&titles=Fish_(New_Horizons)'
-
-    @commands.command(aliases=['fi', 'fish'])
-    async def fishinfo(self, ctx, *query):
-        """ Retrieves fish information for AC:NH. """
-
-        query = ' '.join(query).lower()  # Format query  # TODO breaks for "great white shark"
-
-        r = requests.get(ACNH.fish_url).json()  # Consider using aiohttp (although this seems to be fast enough for now)
-        data = r['query']['pages']['151280']['revisions'][0]['*']
+    # Parsed once from https://animalcrossing.fandom.com/wiki/Fish_(New_Horizons) and kept on disk.
+    fish = FishStore('../cache/fish.json', cfload.settings.acnh.fish_refresh_hours * 3600)
 
-        wikitext = mwp.parse(data)
-        templates = wikitext.filter_templates()
-        filtered_list = list(
-            filter(lambda template: template.name.matches('TableContent') or template.name.matches('roundyR'),
-                   templates))
+    def __init__(self, bot):
+        self.bot = bot
+        cfload.listeners.append(self.on_config_reload)
 
-        # Remove first roundyR. The second one separates north and south hemispheres.
-        roundy_r = filtered_list.pop(0)
-        idx = filtered_list.index(roundy_r)
+    def cog_unload(self):
+        cfload.listeners.remove(self.on_config_reload)
 
-        n_hemisphere = filtered_list[:idx]  # Fish name is at element.params[1]
-        s_hemisphere = filtered_list[idx + 1:]
+    def on_config_reload(self, settings):
+        ACNH.fish.ttl = settings.acnh.fish_refresh_hours * 3600
 
-        results = list(filter(lambda temp: temp.params[1].strip('\n []').lower() == query, n_hemisphere)) + list(
-            filter(lambda temp: temp.params[1].strip('\n []').lower() == query, s_hemisphere))
+    @commands.command(aliases=['fi', 'fish'])
+    async def fishinfo(self, ctx, *query):
+        """ Retrieves fish information for AC:NH. """
 
-        # Get the icon for the embed.
-        # This uses another API call, which sucks, but I can't get the HTML URL from the above wikitext.
-        # It seems unavoidable at the moment.
-        try:
-            icon_name = results[0].params[2].strip('\n []').replace('File:', '').strip().replace(' ', '_')
-        except IndexError:
+        query = ' '.join(query)
+        fish = await ACNH.fish.get(query, self.bot.web)
+        if fish is None:
             await ctx.message.add_reaction('\U00002753')
             return
 
-        html_url = 'https://animalcrossing.fandom.com/api.php?action=parse&page=Fish_(New_Horizons)&prop=text&format=json'
-        html_r = requests.get(html_url).json()
-        html_data = html_r['parse']['text']['*']
-
-        try:
-            pic_url = re.search(f'href="(?P<URL>(.*?){icon_name}(.*?))"', html_data).group('URL')
-        except AttributeError:
-            print('Couldn\'t find', icon_name)
-            await ctx.message.add_reaction('\U00002754')  # TODO remove, or make same color as above reaction (2753)
-            return
-
         # Create the embed
-        fish_name = results[0].params[1].strip(' \n[]')
-        fish_price = str(results[0].params[3].strip(' \n')) + ' bells'
-        fish_shadow_size = results[0].params[5].strip(' \n')
-
-        fish_tod = str(results[0].params[6])
-        clean = re.compile('<.*?>')
-        fish_tod = re.sub(clean, '', fish_tod)
-        fish_location = str(results[0].params[4]).strip(' \n') + ', ' + fish_tod
-
-        fish_north_times = results[0].params[7:19]
-        fish_south_times = None
-        if len(results) >= 2:
-            fish_south_times = results[1].params[7:19]  # TODO breaks here
-        fish_north_months = ''
-        fish_south_months = ''
-
-        months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-        n_num = 0
-        s_num = 0
-        for n in range(len(fish_north_times)):
-            if fish_north_times[n].value.strip(' \n') == '✓':
-                fish_north_months += months[n] + ', '
-                n_num += 1
-            if fish_south_times is not None and fish_south_times[n].value.strip(' \n') == '✓':
-                fish_south_months += months[n] + ', '
-                s_num += 1
-
-        fish_north_months = fish_north_months[:-2]
-        fish_south_months = fish_south_months[:-2]
-
-        if n_num == 12:
-            fish_north_months = 'All year'
-
-        if s_num == 12:
-            fish_south_months = 'All year'
+        fish_name = fish['name']
+        fish_price = fish['price'] + ' bells'
+        fish_shadow_size = fish['shadow_size']
+        fish_location = fish['location'] + ', ' + fish['time']
+        fish_north_months = FishStore.format_months(fish['north'])
+        fish_south_times = fish['south']
 
         embed = discord.Embed(title=fish_name,
                               colour=discord.Colour(0x44b9e3))  # , url="fish_url")  # TODO add url to fish page
@@ -106,12 +51,49 @@ class ACNH(commands.Cog):
         embed.add_field(name="Shadow size", value=fish_shadow_size, inline=False)
         embed.add_field(name="Northern Hemisphere", value=fish_north_months, inline=True)
         if fish_south_times is not None:
-            embed.add_field(name="Southern Hemisphere", value=fish_south_months, inline=True)
+            embed.add_field(name="Southern Hemisphere", value=FishStore.format_months(fish_south_times), inline=True)
         # embed.add_field(name="Description",
         #                 value="The blue marlin (力ジキマグロ, swordfish?), known as the swordfish in Animal Forest e+, is a rare fish in the Animal Crossing series. In Animal Forest e+ it is only seen in the sea around the Private Island, where it makes occasional appearances as an arapaima-sized shadow. However, due to the current of the island, some are impossible to catch as they are too far out to reach. The fish can be found all day and has a huge size.")
 
         await ctx.send('This feature is currently in beta. Please be patient with glitches and errors.', embed=embed)
 
+    @commands.command(aliases=['now'])
+    async def catchable(self, ctx, hemisphere='north', hour: int = None):
+        """ Lists the fish you can catch right now (or at another hour, 0-23), most valuable first. """
+        hemisphere = FishIndex.hemisphere(hemisphere)
+        if hemisphere is None or hour is not None and not 0 <= hour < 24:
+            return await ctx.message.add_reaction('\U00002753')  # question mark
+
+        now = time.localtime()
+        hour = now.tm_hour if hour is None else hour
+        fish = await ACNH.fish.catchable(self.bot.web, hemisphere, now.tm_mon - 1, hour)
+        title = f'Catchable in the {hemisphere}ern hemisphere, {FishStore.months[now.tm_mon - 1]} at {hour}:00'
+        await ctx.send(embed=ACNH.fish_list(title, fish))
+
+    @commands.command()
+    async def leaving(self, ctx, hemisphere='north'):
+        """ Lists the fish you can only catch until the end of this month, most valuable first. """
+        hemisphere = FishIndex.hemisphere(hemisphere)
+        if hemisphere is None:
+            return await ctx.message.add_reaction('\U00002753')  # question mark
+
+        month = time.localtime().tm_mon - 1
+        fish = await ACNH.fish.leaving(self.bot.web, hemisphere, month)
+        title = f'Leaving the {hemisphere}ern hemisphere after {FishStore.months[month]}'
+        await ctx.send(embed=ACNH.fish_list(title, fish))
+
+    @staticmethod
+    def fish_list(title, fish):
+        """An embed listing fish with their price, location and time, cut off at Discord's description limit."""
+        lines = [f'**{f["name"]}** - {f["price"]} bells, {f["location"]}, {f["time"]}' for f in fish] or ['None']
+        description = ''
+        for n, line in enumerate(lines):
+            if len(description) + len(line) > 1950:
+                description += f'...and {len(lines) - n} more'
+                break
+            description += line + '\n'
+        return discord.Embed(title=title, description=description, colour=discord.Colour(0x44b9e3))
+
 
 def setup(bot):
     bot.add_cog(ACNH(bot))
@@ -0,0 +1,289 @@
+import audioop
+import os
+import threading
+import time
+from collections import deque
+
+import discord
+
+
+def is_opus(data):
+    """Whether the audio described by a YTDL info dict is already Opus (usually in a WebM container)."""
+    return data.get('acodec') == 'opus'
+
+
+def find_source(source, cls):
+    """Walks down a chain of wrapped AudioSources (MeteredAudio, PCMVolumeTransformer, ...) to the first cls."""
+    while not isinstance(source, cls) and hasattr(source, 'original'):
+        source = source.original
+    return source if isinstance(source, cls) else None
+
+
+def create_audio(audio_input, before_options, data, volume, passthrough, buffer_frames=0):
+    """Creates the AudioSource for a song. FFmpeg's output goes through a BufferedAudio of buffer_frames,
+    unless it's 0.
+
+    If passthrough is set and the song is already Opus, FFmpeg hands Opus packets straight to Discord,
+    so there's no Python volume scaling or encode per 20 ms frame on the player thread. Only at volume 1
+    are the packets copied untouched; any other volume is applied by FFmpeg itself, which has to decode and
+    re-encode (in C, at least). Either way the volume can only change when the next song starts. Otherwise, falls back to PCM with a PCMVolumeTransformer."""
+    def buffered(source):
+        return BufferedAudio(source, buffer_frames) if buffer_frames else source
+
+    if passthrough and is_opus(data):
+        if volume == 1:
+            return buffered(discord.FFmpegOpusAudio(audio_input, before_options=before_options, codec='opus'))  # Copy
+        return buffered(discord.FFmpegOpusAudio(audio_input, before_options=before_options,
+                                                options=f'-filter:a volume={volume:.2f}'))
+    # The volume is applied after the buffer, so changing it takes effect right away
+    return discord.PCMVolumeTransformer(buffered(discord.FFmpegPCMAudio(audio_input, before_options=before_options)),
+                                        volume=volume)
+
+
+class BufferedAudio(discord.AudioSource):
+    """Reads an AudioSource ahead of playback on its own thread.
+
+    The player thread has to hand Discord a frame every 20 ms. Reading them straight from FFmpeg's pipe means
+    any stall (a busy host, a download hogging the disk) is heard as stutter. Here a reader thread keeps up to
+    depth frames buffered instead. If the buffer runs dry anyway, read() plays silence rather than blocking
+    (an underrun), and only resumes once a quarter of the buffer has refilled, so a transient stall is heard as
+    one short gap rather than crackling until FFmpeg catches up."""
+
+    pcm_silence = bytes(discord.opus.Encoder.FRAME_SIZE)
+    opus_silence = b'\xf8\xff\xfe'
+    underruns_total = 0  # Across every stream, for the stats
+    underruns_lock = threading.Lock()
+
+    def __init__(self, original, depth):
+        self.original = original
+        self.depth = depth
+        self.refill = max(1, depth // 4)
+        self.silence = BufferedAudio.opus_silence if original.is_opus() else BufferedAudio.pcm_silence
+        self.frames = deque()
+        self.changed = threading.Condition()  # Notified whenever frames is added to or taken from
+        self.started = False
+        self.ended = False  # The original source has run out
+        self.stopped = False
+        self.buffering = False  # Playing silence until the buffer refills
+        self.underruns = 0
+        self.silent_frames = 0
+        threading.Thread(target=self.fill, name='audio-buffer', daemon=True).start()
+
+    def fill(self):
+        """Reads frames until the original source ends. Runs on the reader thread."""
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: len(self.frames) < self.depth or self.stopped)
+                if self.stopped:
+                    return
+            try:
+                frame = self.original.read()
+            except (OSError, ValueError):  # FFmpeg was killed by cleanup()
+                frame = b''
+            with self.changed:
+                if frame:
+                    self.frames.append(frame)
+                else:
+                    self.ended = True
+                self.changed.notify_all()
+            if not frame:
+                return
+
+    def read(self):
+        with self.changed:
+            if self.stopped:
+                return b''
+            if not self.started:  # Wait for the first frames, like reading from FFmpeg directly would
+                self.changed.wait_for(lambda: len(self.frames) >= self.refill or self.ended or self.stopped)
+                self.started = True
+            if self.buffering and (len(self.frames) >= self.refill or self.ended):
+                self.buffering = False
+            if not self.buffering:
+                if self.frames:
+                    frame = self.frames.popleft()
+                    self.changed.notify_all()
+                    return frame
+                if self.ended:
+                    return b''
+                self.buffering = True
+                self.underruns += 1
+                with BufferedAudio.underruns_lock:
+                    BufferedAudio.underruns_total += 1
+            self.silent_frames += 1
+            return self.silence
+
+    def fill_level(self):
+        """How full the buffer is, 0-1."""
+        return len(self.frames) / self.depth
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        with self.changed:
+            self.stopped = True
+            self.changed.notify_all()
+        self.original.cleanup()
+
+
+class TrackDeck(discord.AudioSource):
+    """Plays songs back to back as one AudioSource, so the next song can start without stopping the voice client.
+
+    The player cues the next song (FFmpeg already running, its BufferedAudio filling) before the current one ends.
+    When the current song runs out, read() carries on with the cued one in the same 20 ms frame, and calls
+    on_switch(old, new, tag, gap) from the audio thread. With crossfade_frames, the last frames of a PCM song
+    are mixed with the start of the next one. That needs the current song's BufferedAudio to know where it ends, so the fade
+    is at most as long as the buffer. If nothing is cued in time, read() returns b'' and the voice client stops
+    like it would after a single song. The deck is closed from then on, and doesn't take cues anymore."""
+
+    def __init__(self, audio, tag, on_switch, crossfade_frames=0):
+        self.current = audio
+        self.tag = tag  # What's playing, for the player (it's a YTDLSource)
+        self.upcoming = None
+        self.upcoming_tag = None
+        self.on_switch = on_switch
+        self.crossfade_frames = crossfade_frames
+        self.fade_frames = 0  # Length of the fade in progress, if any
+        self.skipping = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def cue(self, audio, tag):
+        """Sets the song to play when the current one ends. Returns the one cued before (or None), which the caller
+        should clean up, off the event loop since that waits for FFmpeg to exit. Returns False if the deck has
+        already stopped, in which case audio isn't used."""
+        with self.lock:
+            if self.closed:
+                return False
+            old, self.upcoming, self.upcoming_tag = self.upcoming, audio, tag
+        return old
+
+    def skip(self):
+        """Ends the current song at the next frame."""
+        self.skipping = True
+
+    def read(self):
+        # Reads can block on FFmpeg, so the lock is only held to swap songs. cue() takes it from the event loop.
+        if self.skipping:
+            self.skipping = False
+            self.fade_frames = 0
+            frame = b''
+        elif self.fading():
+            return self.mix()
+        else:
+            frame = self.current.read()
+        if frame:
+            return frame
+        ended = time.perf_counter()
+        with self.lock:
+            if self.upcoming is None:
+                self.closed = True
+                return b''
+            old, self.current, self.tag = self.current, self.upcoming, self.upcoming_tag
+            self.upcoming, self.upcoming_tag = None, None
+        self.fade_frames = 0
+        frame = self.current.read()
+        self.on_switch(old, self.current, self.tag, time.perf_counter() - ended)
+        return frame
+
+    def fading(self):
+        """Whether the current song is close enough to its end to start fading into the cued one."""
+        if self.fade_frames:
+            return True
+        upcoming = self.upcoming  # cue() can change it meanwhile
+        buffer = getattr(self.current, 'buffer', None)
+        if (not self.crossfade_frames or upcoming is None or buffer is None or not buffer.ended
+                or self.current.is_opus() or upcoming.is_opus()):
+            return False
+        remaining = len(buffer.frames)
+        if remaining > self.crossfade_frames or remaining < 2:
+            return False
+        self.fade_frames = remaining
+        return True
+
+    def mix(self):
+        upcoming = self.upcoming
+        outgoing = self.current.read()
+        incoming = upcoming.read() if upcoming is not None else b''  # Uncued mid-fade
+        if not outgoing or not incoming:  # The fade is over, switch on the next read
+            self.fade_frames = 0
+            return incoming or outgoing or self.silence()
+        left = len(self.current.buffer.frames) / self.fade_frames
+        return audioop.add(audioop.mul(outgoing, 2, left), audioop.mul(incoming, 2, 1 - left), 2)
+
+    def silence(self):
+        return BufferedAudio.opus_silence if self.is_opus() else BufferedAudio.pcm_silence
+
+    def is_opus(self):
+        # The voice client checks this every frame, so Opus and PCM songs can follow each other
+        return self.current.is_opus()
+
+    def cleanup(self):
+        # The cued song is left to the player, which plays it next or kills it in uncue()
+        with self.lock:
+            self.closed = True
+        self.current.cleanup()
+
+
+class MeteredAudio(discord.AudioSource):
+    """Wraps an AudioSource and measures how much CPU it costs to play.
+
+    The player thread reads a frame, encodes it (unless it's Opus already), sends it and sleeps until
+    the next frame, so the thread CPU time between two reads is everything this stream costs in Python.
+    FFmpeg's share is read from /proc, so it's only available on Linux."""
+
+    clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+    def __init__(self, original):
+        self.original = original
+        self.started = None
+        self.cpu_time = 0.  # Seconds of player thread CPU time
+        self.frames = 0
+        self.first_frame = None  # When the first frame came out, which can take a while with FFmpeg starting up
+        self.buffer = find_source(original, BufferedAudio)
+        self._last_read = None
+
+    def read(self):
+        now = time.thread_time()
+        if self._last_read is None:
+            self.started = time.perf_counter()
+        else:
+            self.cpu_time += now - self._last_read
+        self._last_read = now
+        self.frames += 1
+        frame = self.original.read()
+        if self.first_frame is None:
+            self.first_frame = time.perf_counter()
+        return frame
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    def ffmpeg_cpu_time(self):
+        """Seconds of CPU time used by this stream's FFmpeg process, or None if it can't be measured."""
+        process = getattr(find_source(self.original, discord.FFmpegAudio), '_process', None)
+        if process is None:
+            return None
+        try:
+            with open(f'/proc/{process.pid}/stat') as f:
+                # The process name can contain spaces, so skip past it. utime and stime are fields 14 and 15.
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / MeteredAudio.clock_ticks
+
+    def played(self):
+        """Seconds of the song played so far, not counting the silence played during underruns."""
+        silent = self.buffer.silent_frames if self.buffer is not None else 0
+        return (self.frames - silent) * .02  # Discord reads 20 ms frames
+
+    def usage(self):
+        """Returns (python, ffmpeg) CPU usage as a fraction of one core since playback started."""
+        if self.started is None:
+            return 0., 0.
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        ffmpeg = self.ffmpeg_cpu_time()
+        return self.cpu_time / elapsed, (ffmpeg / elapsed if ffmpeg is not None else None)
@@ -0,0 +1,300 @@
+"""Benchmarks the real cogs under load, without Discord or the network.
+Run from src/ with: python -m benchmarks.bot_load [guilds ...]
+
+Messages go through the bot's normal get_context/invoke path, driven by a fake gateway instead of a
+websocket. The wiki, Reddit and YouTube are replaced with local stand-ins that answer after upstream_delay,
+and songs "play" into a null voice client, so no FFmpeg is needed either.
+Reports throughput, and p50/p99 latency per command, for each number of simultaneous guilds."""
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+
+import discord
+
+src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+upstream_delay = .02  # Seconds every fake upstream takes to answer
+song_seconds = .05
+rounds = 2  # Times each guild runs through the script
+# What every guild sends, in order. {i} is replaced with the guild's number.
+script = ('ping', 'rolldice 2d6', 'minesweeper 8 8 10', 'fishinfo goldfish', 'catchable north', 'meme',
+          'play song {i}', 'queue', 'qr example.com/{i}')
+fish_names = ['Goldfish', 'Koi', 'Sea bass', 'Coelacanth', 'Stringfish'] + [f'Fish {n}' for n in range(75)]
+
+
+def make_settings(cfload):
+    """Default settings, except for streaming (nothing to download) and no stats file."""
+    return cfload.Settings(
+        startup=cfload.StartupSettings(token='benchmark'),
+        commands=cfload.CommandSettings(),
+        owner=cfload.OwnerSettings(owner_id=1),
+        reddit=cfload.RedditSettings(),
+        music=cfload.MusicSettings(playback_mode='stream'),
+        acnh=cfload.ACNHSettings(),
+        http=cfload.HTTPSettings(),
+        cpu=cfload.CPUSettings(),
+        stats=cfload.StatsSettings(dump_path=''),
+        sharding=cfload.ShardingSettings(),
+        logging=cfload.LoggingSettings(level='WARNING'),
+    )
+
+
+# Upstreams
+
+class FakeWeb:
+    """Stands in for bot.web, answering the fish store's wiki API calls."""
+
+    months = '|'.join(['✓'] * 6 + ['-'] * 6)
+
+    def __init__(self):
+        self.latency = {}
+        rows = ''.join(f'{{{{TableContent|a|[[{name}]]|[[File:{name} NH Icon.png]]|{random.randint(100, 15000)}|River|'
+                       f'Small (2)|All day|{FakeWeb.months}}}}}\n' for name in fish_names)
+        self.wikitext = f'{{{{roundyR}}}}\n{rows}{{{{roundyR}}}}\n{rows}'
+        self.html = ''.join(f'<a href="https://static.example/{name.replace(" ", "_")}_NH_Icon.png">'
+                            for name in fish_names)
+
+    async def get_json(self, url, params=None, **kwargs):
+        await asyncio.sleep(upstream_delay)
+        if params.get('action') == 'parse':
+            return {'parse': {'text': {'*': self.html}}}
+        revision = {'revid': 1, '*': self.wikitext}
+        return {'query': {'pages': {'1': {'revisions': [revision]}}}}
+
+    async def close(self):
+        pass
+
+
+class FakeReddit:
+    """Stands in for praw.Reddit. Listings take upstream_delay, like one request would."""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def subreddit(self, name):
+        return types.SimpleNamespace(over18=False, hot=lambda limit: self.hot(name, limit))
+
+    @staticmethod
+    def hot(name, limit):
+        time.sleep(upstream_delay)
+        for n in range(limit):
+            yield types.SimpleNamespace(title=f'Post {n}', permalink=f'/r/{name}/comments/{n}', url=f'https://i.example/{n}.png',
+                                        author=f'user{n}', selftext='', score=n, num_comments=n, subreddit=name,
+                                        stickied=False)
+
+
+def fake_extract_info(cls, query):
+    time.sleep(upstream_delay)
+    video_id = str(abs(hash(query)))
+    return {'id': video_id, 'extractor': 'youtube', 'title': query, 'webpage_url': f'https://youtube.example/{video_id}',
+            'url': f'https://media.example/{video_id}', 'duration': song_seconds, 'ext': 'webm', 'acodec': 'opus'}
+
+
+# Discord
+
+class NullAudio(discord.AudioSource):
+    """Silence, in place of FFmpeg."""
+
+    frame = bytes(3840)
+
+    def read(self):
+        return NullAudio.frame
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient:
+    """A voice client that reads a frame of each song to make sure it plays, then ends it after song_seconds."""
+
+    def __init__(self, guild, loop):
+        self.guild = guild
+        self.loop = loop
+        self.ending = None
+        self.after = None
+
+    def play(self, source, after=None):
+        source.read()
+        self.after = after
+        self.ending = self.loop.call_later(song_seconds, after, None)
+
+    def stop(self):
+        if self.ending is not None:
+            self.ending.cancel()
+            self.after(None)
+
+    def is_playing(self):
+        return self.ending is not None and not self.ending.cancelled()
+
+    def pause(self):
+        pass
+
+    def resume(self):
+        pass
+
+    async def disconnect(self):
+        self.guild.voice_client = None
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild, loop):
+        self.guild = guild
+        self.loop = loop
+
+    async def connect(self):
+        if self.guild.voice_client is not None:
+            raise discord.errors.ClientException('Already connected to a voice channel.')
+        self.guild.voice_client = FakeVoiceClient(self.guild, self.loop)
+        return self.guild.voice_client
+
+
+class FakeMessage:
+    def __init__(self, content, author, guild):
+        self.id = random.getrandbits(63)
+        self.content = content
+        self.author = author
+        self.guild = guild
+        self.channel = guild.channel
+        self._state = None
+        self.reactions = []
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+    async def remove_reaction(self, emoji, member):
+        pass
+
+    async def delete(self, **kwargs):
+        pass
+
+
+class FakeGateway:
+    """Plays the part of Discord: owns the fake guilds and delivers their messages to the bot."""
+
+    def __init__(self, bot, context_class, prefix):
+        self.bot = bot
+        self.context_class = context_class
+        self.prefix = prefix
+        self.user = types.SimpleNamespace(id=0, name='Alfred', bot=True, mention='<@0>')
+        bot._connection.user = self.user
+        self.next_id = 1000
+
+    def create_guild(self):
+        self.next_id += 1
+        guild = types.SimpleNamespace(id=self.next_id, shard_id=0, voice_client=None, me=self.user)
+        guild.channel = types.SimpleNamespace(id=self.next_id, guild=guild)
+        author = types.SimpleNamespace(id=self.next_id, name=f'user{self.next_id}', bot=False,
+                                       mention=f'<@{self.next_id}>')
+        author.voice = types.SimpleNamespace(channel=FakeVoiceChannel(guild, self.bot.loop))
+        guild.author = author
+        return guild
+
+    async def send(self, guild, content):
+        """Delivers a message from the guild's user, and returns it once the command is done."""
+        message = FakeMessage(self.prefix + content, guild.author, guild)
+        ctx = await self.bot.get_context(message, cls=self.context_class)
+        await self.bot.invoke(ctx)
+        return message
+
+
+def load_bot():
+    """Builds the real bot with the real cogs, wired to the fakes above."""
+    import configloader as cfload
+    cfload.settings = make_settings(cfload)
+    from logger import Logger as log
+    log.output_logs = False  # Failures are counted in the report instead
+    log.configure(cfload.settings.logging)
+
+    import main
+    import praw
+    from discord.ext import commands
+
+    class BenchContext(commands.Context):
+        async def send(self, content=None, **kwargs):
+            return FakeMessage(content, self.me, self.guild)
+
+    praw.Reddit = FakeReddit  # The Commands cog logs in as soon as it's loaded
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = main.Alfred(command_prefix=main.get_prefix, loop=loop)
+    bot.web = FakeWeb()
+
+    async def change_presence(**kwargs):
+        pass
+    bot.change_presence = change_presence
+
+    for extension in ('commands', 'music', 'acnh', 'stats'):
+        bot.load_extension(extension)
+    # Extensions are separate module objects from a plain import, so patch the ones the bot actually uses.
+    music = bot.extensions['music']
+    music.YTDLSource.extract_info = classmethod(fake_extract_info)
+    music.create_audio = lambda *args: NullAudio()
+    return bot, FakeGateway(bot, BenchContext, cfload.settings.commands.command_prefix)
+
+
+def percentile(samples, q):
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+async def run_guilds(gateway, n):
+    """Runs the script in n guilds at once. Returns the wall time, every command's latency and failures."""
+    latency = defaultdict(list)
+    failures = defaultdict(int)
+    guilds = [gateway.create_guild() for _ in range(n)]
+
+    async def run_guild(i, guild):
+        for _ in range(rounds):
+            for line in script:
+                start = time.perf_counter()
+                message = await gateway.send(guild, line.format(i=i))
+                name = line.split()[0]
+                latency[name].append(time.perf_counter() - start)
+                if '\U0000274C' in message.reactions:  # Cross mark
+                    failures[name] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_guild(i, guild) for i, guild in enumerate(guilds)))
+    return time.perf_counter() - start, latency, failures
+
+
+async def benchmark(bot, gateway, guild_counts):
+    await gateway.send(gateway.create_guild(), 'fishinfo goldfish')  # Parse the fish page once up front
+    for n in guild_counts:
+        elapsed, latency, failures = await run_guilds(gateway, n)
+        total = sum(len(samples) for samples in latency.values())
+        print(f'\n{n} guilds: {total} commands in {elapsed:.2f} s, {total / elapsed:.0f} commands/s')
+        print(f'{"command":>12} {"p50 (ms)":>10} {"p99 (ms)":>10} {"failed":>7}')
+        for name, samples in latency.items():
+            samples.sort()
+            print(f'{name:>12} {percentile(samples, .5) * 1000:>10.2f} {percentile(samples, .99) * 1000:>10.2f} '
+                  f'{failures[name]:>7}')
+        await asyncio.sleep(song_seconds * 4)  # Let the players finish their queues
+    print(f'\nEvent loop lag: {bot.get_cog("Stats").monitor.lag.summary()}')
+
+
+def main(guild_counts=(1, 100, 1000)):
+    # The cogs keep their caches in ../cache and ../music_cache, so run somewhere they can't touch real data.
+    sys.path.insert(0, src)
+    work = os.path.join(tempfile.mkdtemp(prefix='alfred-bench-'), 'src')
+    os.makedirs(work)
+    os.chdir(work)
+    logging.getLogger('discord').setLevel(logging.WARNING)
+    bot, gateway = load_bot()
+    try:
+        bot.loop.run_until_complete(benchmark(bot, gateway, guild_counts))
+    finally:
+        bot.cpu.shutdown()
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or (1, 100, 1000))
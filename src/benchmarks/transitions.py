@@ -0,0 +1,131 @@
+"""Measures the silence between songs, with and without gapless playback.
+Run from src/ with: python -m benchmarks.transitions
+
+A real MusicPlayer plays a queue of short songs into a voice client that reads a frame every 20 ms on its own
+thread, like discord.py's. Each song stands in for FFmpeg: nothing comes out for spawn_delay (starting FFmpeg
+and probing the input), then it plays song_seconds of noise, with every byte set to the song's number. The gap
+is the longest the listener hears nothing between the last frame of one song and the first of the next."""
+import dataclasses
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import discord
+
+from benchmarks import bot_load
+
+spawn_delay = .15
+song_seconds = 1.
+songs = 6
+
+
+class FakeFFmpeg(discord.AudioSource):
+    def __init__(self, number):
+        self.frame = bytes([number]) * discord.opus.Encoder.FRAME_SIZE
+        self.frames = int(song_seconds / .02)
+
+    def read(self):
+        if self.frames == int(song_seconds / .02):
+            time.sleep(spawn_delay)
+        if not self.frames:
+            return b''
+        self.frames -= 1
+        return self.frame
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        pass
+
+
+class PacedVoiceClient:
+    """Reads a frame every 20 ms on a thread, and notes when each audible one was played."""
+
+    def __init__(self):
+        self.heard = []  # (perf_counter, first byte) of every frame that wasn't silence
+        self.thread = None
+
+    def play(self, source, after=None):
+        self.thread = threading.Thread(target=self.run, args=(source, after), daemon=True)
+        self.thread.start()
+
+    def run(self, source, after):
+        next_frame = time.perf_counter()
+        while True:
+            data = source.read()
+            if not data:
+                break
+            if any(data[:4]):
+                self.heard.append((time.perf_counter(), data[0]))
+            next_frame += .02
+            time.sleep(max(0., next_frame - time.perf_counter()))
+        source.cleanup()
+        after(None)
+
+    def is_playing(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+
+async def play_queue(bot, music):
+    """Plays songs through a new player. Returns the average gap between them in seconds, as the listener hears
+    it and as the player measured it. Mixed frames in a crossfade count as heard."""
+    player = music.MusicPlayer(bot, 0)
+    player.vc = PacedVoiceClient()
+    player.volume = 1.  # Leaves the song numbers alone
+    for n in range(songs):
+        player.queue.put_nowait(music.YTDLSource(f'song {n}', {'title': f'Song {n}', 'url': f'{n + 1}',
+                                                              'webpage_url': f'https://youtube.example/{n}',
+                                                              'duration': song_seconds}))
+    music.Music.players[0] = player
+    player.start()
+    await player.task
+    heard = player.vc.heard
+    gaps = []
+    for n in range(1, songs):
+        last = max(i for i, (_, song) in enumerate(heard) if song == n)
+        first = min(i for i, (_, song) in enumerate(heard) if song == n + 1)
+        gaps.append(max(0., *(heard[i + 1][0] - heard[i][0] - .02 for i in range(last, first))))
+    return sum(gaps) / len(gaps), player.average_gap()
+
+
+async def benchmark(bot, cfload, music):
+    defaults = cfload.settings
+    print(f'{songs} songs of {song_seconds:.1f} s, {spawn_delay * 1000:.0f} ms for FFmpeg to start')
+    print(f'{"":>20} {"heard gap (ms)":>15} {"measured gap (ms)":>18}')
+    for name, gapless, crossfade_ms in (('after callback', False, 0), ('gapless', True, 0),
+                                        ('crossfade 200 ms', True, 200)):
+        music_settings = dataclasses.replace(defaults.music, gapless=gapless, crossfade_ms=crossfade_ms)
+        cfload.settings = dataclasses.replace(defaults, music=music_settings)
+        heard, measured = await play_queue(bot, music)
+        print(f'{name:>20} {heard * 1000:>15.1f} {measured * 1000:>18.1f}')
+
+
+def main():
+    sys.path.insert(0, bot_load.src)
+    work = os.path.join(tempfile.mkdtemp(prefix='alfred-bench-'), 'src')
+    os.makedirs(work)
+    os.chdir(work)
+    bot, _ = bot_load.load_bot()
+    import configloader as cfload
+    from audio import BufferedAudio
+    music = bot.extensions['music']
+    # The media URL is the song's number
+    music.create_audio = lambda audio_input, before_options, data, volume, passthrough, buffer_frames: \
+        discord.PCMVolumeTransformer(BufferedAudio(FakeFFmpeg(int(audio_input)), buffer_frames), volume=volume)
+    try:
+        bot.loop.run_until_complete(benchmark(bot, cfload, music))
+    finally:
+        bot.cpu.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,8 @@
+import configloader as cfload
+from discord.ext import commands
+
+
+def owner_only():
+    """Check that only lets the owner from config.ini use a command.
+    Lives here rather than in a cog, so cogs can share it without importing (and pinning) each other."""
+    return commands.check(lambda ctx: ctx.author.id == cfload.settings.owner.owner_id)
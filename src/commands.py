@@ -1,22 +1,38 @@
+from collections import OrderedDict
 from io import BytesIO
 
 import configloader as cfload
 import discord
-import praw
-import qrcode
+import minesweeper
 import random
+from checks import owner_only
+from cpujobs import CPUJobs, render_qr
 from discord.ext import commands
+from lazyimport import LazyModule
 from logger import Logger as log
+from redditpool import RedditPool
+
+redditclient = LazyModule('redditclient')  # PRAW takes a while to import, so it's done on the pool's thread
 
-cfload.read('..\\config.ini')
-log.info(cfload.configSectionMap("Owner Credentials")['owner_id'], "is the owner. Only this user can use /shutdown.")
 
 class Commands(commands.Cog):
     """Various commands"""
     prune_cutoff = 25
+    qr_box_size = 10  # Pixels per QR code module  # TODO shrink img size (maybe)
+    qr_cache_size = 128
 
     def __init__(self, bot):
         self.bot = bot
+        # One authenticated Reddit client for the bot's whole lifetime, feeding the /meme post pools.
+        log.info(cfload.settings.owner.owner_id, "is the owner. Only this user can use /shutdown.")
+        credentials = cfload.settings.reddit
+        self.memes = RedditPool(lambda: redditclient.connect(credentials, self.bot.web.latency), self.bot.loop)
+        self.memes.start('dankmemes')
+        # Recently rendered QR codes, (payload, box size) -> JPEG bytes, least recently used first.
+        self.qr_cache = OrderedDict()
+
+    def cog_unload(self):
+        self.memes.stop()
 
     @commands.command()
     async def ping(self, ctx):
@@ -41,71 +57,65 @@ class Commands(commands.Cog):
     @commands.command(aliases=['sd'])
     async def shutdown(self, ctx):
         """Shuts down the bot."""
-        if ctx.author.id == int(cfload.configSectionMap('Owner Credentials')['owner_id']):
+        if ctx.author.id == cfload.settings.owner.owner_id:
             await ctx.message.add_reaction('\U0001F50C')  # Power plug emoji
             await self.bot.logout()
         else:
             await ctx.message.add_reaction('\U0000274C')  # Cross mark
             await ctx.send("You can't shut me down.", delete_after=15)
 
+    @commands.command()
+    @commands.guild_only()
+    async def shards(self, ctx):
+        """Shows the status of every shard (and worker process, when run by launcher.py)."""
+        if self.bot.cluster_status is not None:
+            workers = dict(self.bot.cluster_status)
+            workers[self.bot.worker] = self.bot.status()  # Our own status is always fresh
+        else:
+            workers = {0: self.bot.status()}
+
+        embed = discord.Embed(title=f'Shards ({self.bot.shard_count})', colour=discord.Colour(0xe7d066))
+        for worker, status in sorted(workers.items()):
+            lines = [f'Shard {shard_id}: {s["guilds"]} guilds, {s["players"]} players, {s["latency"] * 1000:.0f} ms'
+                     for shard_id, s in sorted(status['shards'].items())]
+            here = ' (this one)' if worker == self.bot.worker else ''
+            embed.add_field(name=f'Worker {worker}{here} - {status["voice_clients"]} voice clients',
+                            value='\n'.join(lines) or 'Connecting...', inline=False)
+        embed.set_footer(text=f'This guild is on shard {ctx.guild.shard_id}.')
+        await ctx.send(embed=embed)
+
+    @commands.command()
+    @owner_only()
+    async def restartworker(self, ctx, worker: int):
+        """Gracefully restarts one worker process when running under launcher.py."""
+        if self.bot.restart_requests is None:
+            return await ctx.send('Not running under launcher.py.', delete_after=10)
+        if worker != self.bot.worker and worker not in self.bot.cluster_status:
+            await ctx.message.add_reaction('\U0000274C')  # Cross mark
+            return await ctx.send(f'There is no running worker {worker}.', delete_after=10)
+        self.bot.restart_requests[worker] = True
+        await ctx.message.add_reaction('\U0001F504')  # Counterclockwise arrows
+
+    @commands.command()
+    @owner_only()
+    async def reload(self, ctx, *extensions):
+        """Reloads extensions (all of them by default) in place. Music keeps playing after a short pause."""
+        failed = await self.bot.reload_extensions(extensions)
+        if failed:
+            return await ctx.send(f'Failed to reload {", ".join(failed)}. See the log.', delete_after=15)
+        await ctx.message.add_reaction('\U0001F504')  # Counterclockwise arrows
+
     @commands.command()
     async def meme(self, ctx, subreddit='dankmemes'):  #TODO fix gif playback
         """Gets a random meme from Reddit and posts it.
         Specify a subreddit to get a post from (actually works with any sub). Default is r/dankmemes."""
-        credentials = cfload.configSectionMap("Reddit API")
-
         await ctx.message.add_reaction("\U0000231B")  # hourglass done (not actually done)
 
-        r = praw.Reddit(client_id=credentials['client_id'],
-                        client_secret=credentials['client_secret'],
-                        user_agent=credentials['user_agent'],
-                        username=credentials['username'],
-                        password=credentials['password'])
         try:
-            sub = r.subreddit(subreddit)
-            if sub.over18:
+            post = await self.memes.pick(subreddit)
+            if post is None:
                 return await ctx.message.add_reaction("\U0001F6AB")  # Prohibited
-            n = 100
-            posts = sub.hot(limit=n)
-            rand = random.randint(0, n)
-            for (i, post) in enumerate(posts):  # TODO try random.choice() for the enumeration
-                if i == rand:
-                    embed = discord.Embed(
-                        title=post.title,  #TODO add subreddit link somewhere, maybe use add fields
-                        url='http://www.reddit.com' + post.permalink,
-                        # description=post.name,
-                        colour=discord.Colour(0xe7d066)
-                    )
-                    if post.url != 'https://www.reddit.com' + post.permalink:  # It's an image post
-                        embed.set_image(url=post.url)
-                    embed.set_author(
-                        name='u/' + str(post.author),
-                        url='http://www.reddit.com/user/' + str(post.author),
-                        icon_url=post.author.icon_img
-                    )
-                    if post.selftext is not '':  #If the post is a text post
-                        description = post.selftext[:1021] + '...' if len(post.selftext) > 1024 else post.selftext
-                        embed.add_field(
-                            name=str(post.score) + ' points',
-                            value=description
-                        )
-                    else:  #If the post is a link post
-                        embed.add_field(
-                            name='Score:',
-                            value=post.score,
-                            inline=True
-                        )
-                        embed.add_field(
-                            name='Comments:',
-                            value=str(len(post.comments)),
-                            inline=True
-                        )
-                    embed.set_footer(
-                        text='r/' + str(post.subreddit),
-                        icon_url='https://styles.redditmedia.com/t5_6/styles/communityIcon_a8uzjit9bwr21.png'
-                    )
-
-                    await ctx.send(embed=embed)
+            await ctx.send(embed=Commands.meme_embed(post))
 
         except Exception as e:
             await ctx.message.add_reaction("\U0000274C")  # Cross mark
@@ -113,16 +123,96 @@ class Commands(commands.Cog):
         finally:
             await ctx.message.remove_reaction('\U0000231B', ctx.me)
 
+    @staticmethod
+    def meme_embed(post):
+        """Builds an embed for a post from the RedditPool."""
+        embed = discord.Embed(
+            title=post['title'],  #TODO add subreddit link somewhere, maybe use add fields
+            url='http://www.reddit.com' + post['permalink'],
+            colour=discord.Colour(0xe7d066)
+        )
+        if post['url'] != 'https://www.reddit.com' + post['permalink']:  # It's an image post
+            embed.set_image(url=post['url'])
+        embed.set_author(
+            name='u/' + post['author'],
+            url='http://www.reddit.com/user/' + post['author']
+        )
+        if post['selftext'] != '':  #If the post is a text post
+            embed.add_field(
+                name=str(post['score']) + ' points',
+                value=post['selftext']
+            )
+        else:  #If the post is a link post
+            embed.add_field(
+                name='Score:',
+                value=post['score'],
+                inline=True
+            )
+            embed.add_field(
+                name='Comments:',
+                value=str(post['num_comments']),
+                inline=True
+            )
+        embed.set_footer(
+            text='r/' + post['subreddit'],
+            icon_url='https://styles.redditmedia.com/t5_6/styles/communityIcon_a8uzjit9bwr21.png'
+        )
+        return embed
+
+    @commands.command()
+    async def upstreams(self, ctx):
+        """Shows the latency distribution of every upstream the bot talks to (wiki, Reddit, ...)."""
+        if not self.bot.web.latency:
+            return await ctx.send('No requests made yet.', delete_after=10)
+        embed = discord.Embed(title='Upstream latency', colour=discord.Colour(0xe7d066))
+        for host, histogram in sorted(self.bot.web.latency.items()):
+            embed.add_field(name=host, value=histogram.summary(), inline=False)
+        await ctx.send(embed=embed)
+
+    @commands.command()
+    @commands.guild_only()
+    async def triggers(self, ctx):
+        """Lists the auto-reactions and whether they're on in this server."""
+        engine = self.bot.triggers
+        embed = discord.Embed(title='Triggers', colour=discord.Colour(0xe7d066))
+        for name, trigger in sorted(engine.triggers.items()):
+            state = 'on' if engine.enabled(ctx.guild.id, name) else 'off'
+            average = trigger.seconds / trigger.hits * 1000 if trigger.hits else 0
+            embed.add_field(name=f'{name} ({state})', value=f'{", ".join(trigger.words).lower()}\n'
+                                                            f'{trigger.hits} hits, {average:.0f} ms each', inline=False)
+        scan = engine.scan_seconds / engine.messages * 10**6 if engine.messages else 0
+        embed.set_footer(text=f'{engine.messages} messages checked, {scan:.1f} µs each')
+        await ctx.send(embed=embed)
+
+    @commands.command()
+    @commands.guild_only()
+    @commands.has_permissions(manage_guild=True)
+    async def trigger(self, ctx, name, state: bool):
+        """Turns an auto-reaction on or off in this server. Example: "/trigger greeting off"."""
+        try:
+            self.bot.triggers.set_enabled(ctx.guild.id, name, state)
+        except KeyError:
+            return await ctx.send(f'There is no trigger called {name}. See /triggers.', delete_after=10)
+        await ctx.message.add_reaction("\U00002705")  # white heavy check mark
+
     @commands.command()
     async def qr(self, ctx, *link: str):
         """Generates a QR code from a provided link."""
         link = ' '.join(link)
-        img = qrcode.make(link)  # TODO Run in executor # TODO shrink img size (maybe)
-        file = BytesIO()
-        img.save(file, 'JPEG')  # TODO Run in executor
-        file.seek(0)
+        key = (link, Commands.qr_box_size)
+        jpeg = self.qr_cache.get(key)
+        if jpeg is None:
+            try:
+                jpeg = await self.bot.cpu.run(ctx.author.id, render_qr, link, Commands.qr_box_size)
+            except CPUJobs.Busy:
+                return await ctx.message.add_reaction('\U000023F3')  # Hourglass not done
+            self.qr_cache[key] = jpeg
+            if len(self.qr_cache) > Commands.qr_cache_size:
+                self.qr_cache.popitem(last=False)
+        else:
+            self.qr_cache.move_to_end(key)
         url = link if 'http://' in link else 'http://' + link
-        await ctx.send(url, file=discord.File(file, 'qr.jpeg'))
+        await ctx.send(url, file=discord.File(BytesIO(jpeg), 'qr.jpeg'))
 
     @commands.command(aliases=['ms'])
     async def minesweeper(self, ctx, width: int = 5, height: int = 5, mines: int = 5, debug=None):
@@ -133,48 +223,17 @@ class Commands(commands.Cog):
             await ctx.send('Please enter width, height, and number of mines greater than zero.', delete_after=10)
             return
 
-        # Max board that doesn't break is 13x13. TODO restrict this? max len is 2048 chars
-        minefield = [[0 for h in range(height)] for w in range(width)]
-
-        for i in range(mines):
-            while True:  # TODO consider replacing with random.choice() for the lists
-                # Find an empty space and place a mine there
-                x, y = random.randint(0, width - 1), random.randint(0, height - 1)
-                if minefield[x][y] != 'M':
-                    minefield[x][y] = 'M'
-                    break
-        # Mark the other ones
-        for x in range(width):
-            for y in range(height):
-                if minefield[x][y] != 'M':
-                    total_mines = 0
-                    # Check the 8 tiles around it
-                    for dy in range(-1, 2):
-                        for dx in range(-1, 2):
-                            if 0 <= x + dx < width and 0 <= y + dy < height:
-                                total_mines += int(minefield[x + dx][y + dy] == 'M')
-                    minefield[x][y] = total_mines
-
-        # Convert the numbers to emoji
-        for x in range(width):
-            for y in range(height):
-                if minefield[x][y] == 'M':
-                    minefield[x][y] = '\U0001F4A3'
-                else:
-                    # Convert the number to its proper keycap emoji variant
-                    minefield[x][y] = f'\\U0000003{str(minefield[x][y])}\\U0000FE0F\\U000020E3'.encode().decode('unicode-escape')
-
-        # Create string to send
-        text_field = 'Minesweeper:\n'
-        spoiler = lambda s: '||' + s + '||'
-
-        for x in range(width):
-            for y in range(height):
-                text_field += spoiler(minefield[x][y]) if not debug == '1' else minefield[x][y]
-                text_field += ' '
-            text_field += '\n'
-
-        await ctx.send(text_field)
+        try:
+            minesweeper.check_size(width, height, reveal=debug == '1')  # Before numpy sees a 6000x6000 board
+            board = minesweeper.generate(width, height, mines)
+            messages = minesweeper.render(board, reveal=debug == '1')
+        except ValueError as e:
+            await ctx.send(str(e), delete_after=10)
+            return
+
+        # Boards too long for one message are split between rows.
+        for message in messages:
+            await ctx.send(message)
 
     @commands.command(aliases=['rd'])
     async def rolldice(self, ctx, ndm):
@@ -1,19 +1,251 @@
+import asyncio
 import configparser
+import dataclasses
+import os
+from typing import Tuple
 
-loader = configparser.ConfigParser()
+from logger import Logger as log
 
-def configSectionMap(section):
-    dict = {}
-    options = loader.options(section)
-    for option in options:
+
+class ConfigError(ValueError):
+    """Raised when config.ini is missing options or has invalid values."""
+
+
+# Each section of config.ini is parsed into one of these. A field without a default is required.
+# Settings are frozen, so handlers can read them without copying and a reload swaps them all at once.
+
+@dataclasses.dataclass(frozen=True)
+class StartupSettings:
+    token: str
+    description: str = ''
+    startup_extensions: Tuple[str, ...] = ('commands', 'music', 'stats')
+
+
+@dataclasses.dataclass(frozen=True)
+class CommandSettings:
+    command_prefix: str = '/'
+
+
+@dataclasses.dataclass(frozen=True)
+class OwnerSettings:
+    owner_id: int
+
+
+@dataclasses.dataclass(frozen=True)
+class RedditSettings:
+    client_id: str = ''
+    client_secret: str = ''
+    user_agent: str = ''
+    username: str = ''
+    password: str = ''
+
+
+@dataclasses.dataclass(frozen=True)
+class MusicSettings:
+    cache_size_mb: int = 2048
+    playback_mode: str = 'download'
+    opus_passthrough: bool = False
+    prebuffer_seconds: float = 30.
+    lookahead: int = 3
+    ytdl_workers: int = 4
+    presence_interval: float = 15.
+    presence_rotate_seconds: float = 60.
+    max_queue: int = 100
+    idle_minutes: float = 10.
+    buffer_ms: int = 1000
+    gapless: bool = True
+    crossfade_ms: int = 0
+    query_cache_days: float = 7.
+    query_cache_size: int = 1000
+
+    def validate(self):
+        if self.playback_mode not in ('stream', 'download'):
+            yield f'playback_mode must be stream or download, not {self.playback_mode}.'
+        if self.buffer_ms < 0:
+            yield 'buffer_ms must be 0 or more.'
+        if self.crossfade_ms > self.buffer_ms:
+            yield 'crossfade_ms can be at most buffer_ms, the fade starts when the rest of the song is buffered.'
+
+
+@dataclasses.dataclass(frozen=True)
+class ACNHSettings:
+    fish_refresh_hours: float = 24.
+
+
+@dataclasses.dataclass(frozen=True)
+class HTTPSettings:
+    limit_per_host: int = 8
+    timeout: float = 10.
+    retries: int = 2
+
+
+@dataclasses.dataclass(frozen=True)
+class CPUSettings:
+    workers: int = 2
+    max_pending: int = 16
+    per_user: int = 2
+
+
+@dataclasses.dataclass(frozen=True)
+class StatsSettings:
+    lag_threshold_ms: float = 250.
+    dump_path: str = '../stats/alfred.prom'
+
+
+@dataclasses.dataclass(frozen=True)
+class ShardingSettings:
+    workers: int = 1
+    shard_count: int = 0  # 0 asks Discord for the recommended number
+
+    def validate(self):
+        if self.workers < 1:
+            yield 'workers must be at least 1.'
+
+
+@dataclasses.dataclass(frozen=True)
+class LoggingSettings:
+    level: str = 'INFO'
+    format: str = 'text'
+    max_bytes: int = 10 * 2**20
+    backup_count: int = 5
+
+    def validate(self):
+        if self.level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+            yield f'level must be DEBUG, INFO, WARNING, ERROR or CRITICAL, not {self.level}.'
+        if self.format not in ('text', 'json'):
+            yield f'format must be text or json, not {self.format}.'
+
+
+@dataclasses.dataclass(frozen=True)
+class Settings:
+    startup: StartupSettings = dataclasses.field(metadata={'section': 'Startup'})
+    commands: CommandSettings = dataclasses.field(metadata={'section': 'Commands'})
+    owner: OwnerSettings = dataclasses.field(metadata={'section': 'Owner Credentials'})
+    reddit: RedditSettings = dataclasses.field(metadata={'section': 'Reddit API'})
+    music: MusicSettings = dataclasses.field(metadata={'section': 'Music'})
+    acnh: ACNHSettings = dataclasses.field(metadata={'section': 'ACNH'})
+    http: HTTPSettings = dataclasses.field(metadata={'section': 'HTTP'})
+    cpu: CPUSettings = dataclasses.field(metadata={'section': 'CPU'})
+    stats: StatsSettings = dataclasses.field(metadata={'section': 'Stats'})
+    sharding: ShardingSettings = dataclasses.field(metadata={'section': 'Sharding'})
+    logging: LoggingSettings = dataclasses.field(metadata={'section': 'Logging'})
+
+
+# The current settings. Always read them through the module (cfload.settings.music...) so reloads are picked up.
+settings = None
+path = None
+mtime = None
+# Called with the new settings after every successful reload.
+listeners = []
+# What's only read at startup: whole sections (None), or just some of their options
+restart_only = {
+    'startup': None,
+    'http': None,
+    'cpu': None,
+    'sharding': None,
+    'music': ('ytdl_workers', 'query_cache_days', 'query_cache_size'),
+}
+
+
+def parse_value(section, option, raw, kind):
+    if kind is bool:
+        if raw.lower() in configparser.ConfigParser.BOOLEAN_STATES:
+            return configparser.ConfigParser.BOOLEAN_STATES[raw.lower()]
+        raise ConfigError(f'[{section}] {option} must be yes or no, not {raw}.')
+    if kind == Tuple[str, ...]:
+        return tuple(raw.split())
+    try:
+        return kind(raw)
+    except ValueError:
+        expected = {int: 'a whole number', float: 'a number'}.get(kind, kind.__name__)
+        raise ConfigError(f'[{section}] {option} must be {expected}, not {raw}.')
+
+
+def parse_section(loader, section, cls, errors):
+    values = {}
+    for f in dataclasses.fields(cls):
+        raw = loader.get(section, f.name, fallback=None)
+        if raw is None or not raw.strip():
+            if f.default is dataclasses.MISSING:
+                errors.append(f'[{section}] {f.name} is required.')
+            continue
+        try:
+            values[f.name] = parse_value(section, f.name, raw.strip(), f.type)
+        except ConfigError as e:
+            errors.append(str(e))
+    if any(f.name not in values and f.default is dataclasses.MISSING for f in dataclasses.fields(cls)):
+        return None
+    result = cls(**values)
+    if hasattr(result, 'validate'):
+        errors.extend(f'[{section}] {error}' for error in result.validate())
+    return result
+
+
+def parse(file):
+    """Reads and validates a config file. Raises ConfigError listing every problem found."""
+    loader = configparser.ConfigParser()
+    try:
+        if not loader.read(file):
+            raise ConfigError(f'Could not read {file}.')
+    except configparser.Error as e:  # Missing section headers, duplicate options...
+        raise ConfigError(f'Invalid config: {e}')
+
+    errors = []
+    sections = {f.name: parse_section(loader, f.metadata['section'], f.type, errors)
+                for f in dataclasses.fields(Settings)}
+    if errors:
+        raise ConfigError('Invalid config:\n' + '\n'.join(errors))
+    return Settings(**sections)
+
+
+def load(file):
+    """Loads and validates the config once at startup."""
+    global settings, path, mtime
+    try:
+        mtime = os.stat(file).st_mtime
+    except OSError:
+        raise ConfigError(f'Could not read {file}.')
+    settings = parse(file)
+    path = file
+    return settings
+
+
+def reload():
+    """Loads the config again if the file changed. Keeps the old settings if the new ones are invalid."""
+    global settings, mtime
+    new_mtime = os.stat(path).st_mtime
+    if new_mtime == mtime:
+        return False
+    mtime = new_mtime
+    try:
+        new_settings = parse(path)
+    except ConfigError as e:
+        log.error('Not reloading config.', e)
+        return False
+
+    old_settings, settings = settings, new_settings
+    for f in dataclasses.fields(Settings):
+        if f.name not in restart_only:
+            continue
+        old, new = getattr(old_settings, f.name), getattr(settings, f.name)
+        if restart_only[f.name] is None:
+            if old != new:
+                log.warning(f'[{f.metadata["section"]}] changed, but only takes effect after a restart.')
+            continue
+        for option in restart_only[f.name]:
+            if getattr(old, option) != getattr(new, option):
+                log.warning(f'[{f.metadata["section"]}] {option} changed, but only takes effect after a restart.')
+    for listener in listeners:
+        listener(settings)
+    log.info('Reloaded config.')
+    return True
+
+
+async def watch(interval=5):
+    """Reloads the config whenever the file changes. Nothing gets restarted, so voice connections carry on."""
+    while True:
+        await asyncio.sleep(interval)
         try:
-            dict[option] = loader.get(section, option)
-            if dict[option] == -1:
-                DebugPrint("skip: %s!" % option)
-        except:
-            print("exception on %s!" % option)
-            dict[option] = None
-    return dict
-
-def read(file):
-    loader.read(file)
\ No newline at end of file
+            reload()
+        except Exception as e:  # A bad listener or a missing file shouldn't stop the watching
+            log.error('Could not reload config.', e)
@@ -0,0 +1,46 @@
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+
+class CPUJobs:
+    """Runs CPU-bound work (image rendering, etc.) on a bounded process pool, so it can't block the event loop.
+    At most max_pending jobs are queued or running at once; anything past that waits its turn.
+    Each user can only have per_user jobs in flight, so one person can't fill the queue."""
+
+    class Busy(Exception):
+        """Raised when a user already has too many jobs running."""
+
+    def __init__(self, workers=2, max_pending=16, per_user=2):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.slots = asyncio.Semaphore(max_pending)
+        self.per_user = per_user
+        self.running = defaultdict(int)  # user ID -> jobs in flight
+
+    async def run(self, user_id, fn, *args):
+        """Runs fn(*args) in a worker process. fn and args must be picklable, so fn has to be module-level."""
+        if self.running[user_id] >= self.per_user:
+            raise CPUJobs.Busy(f'User {user_id} already has {self.per_user} jobs running.')
+        self.running[user_id] += 1
+        try:
+            async with self.slots:
+                return await asyncio.get_event_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.running[user_id] -= 1
+            if not self.running[user_id]:
+                del self.running[user_id]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+# Jobs. These run in the worker processes.
+
+def render_qr(payload, box_size):
+    """Renders payload as a QR code and returns it as JPEG bytes."""
+    import qrcode  # Only the worker processes need it
+    img = qrcode.make(payload, box_size=box_size)
+    file = BytesIO()
+    img.save(file, 'JPEG')
+    return file.getvalue()
@@ -0,0 +1,241 @@
+import asyncio
+import bisect
+import difflib
+import json
+import os
+import re
+import time
+
+from lazyimport import LazyModule
+from logger import Logger as log
+
+mwp = LazyModule('mwparserfromhell')  # Only needed when the page changed
+
+
+class FishIndex:
+    """Every fish query precomputed from the parsed records, so commands are dict lookups.
+
+    Availability is kept as bitmasks: 12 bits of months per hemisphere and 24 bits of hours. From those, the fish
+    catchable at every (hemisphere, month, hour) and leaving after every (hemisphere, month) are listed up front,
+    most valuable first. Names can be looked up exactly, by prefix (of the name or any word in it), or fuzzily."""
+
+    hemispheres = {'n': 'north', 'nh': 'north', 'north': 'north', 's': 'south', 'sh': 'south', 'south': 'south'}
+    hour_range = re.compile(r'(\d{1,2})\s*([AP]M)\s*[-\u2013\u2014]\s*(\d{1,2})\s*([AP]M)', re.IGNORECASE)
+
+    def __init__(self, records):
+        self.fish = {FishStore.normalize(record['name']): record for record in records}
+        self.names = sorted(self.fish)
+        self.words = sorted((word, name) for name in self.names for word in name.split())
+        self.prices = {name: FishIndex.price(record) for name, record in self.fish.items()}
+        self.hours = {name: FishIndex.hour_mask(record['time']) for name, record in self.fish.items()}
+        self.months = {'north': {}, 'south': {}}
+        for name, record in self.fish.items():
+            north = FishIndex.month_mask(record['north'])
+            self.months['north'][name] = north
+            # The south table sometimes misses fish. Seasons are flipped there, so it's the north shifted 6 months.
+            south = record['south']
+            self.months['south'][name] = FishIndex.month_mask(south) if south else (north >> 6 | north << 6) & 0xfff
+
+        by_price = sorted(self.names, key=lambda name: self.prices[name], reverse=True)
+        self.catchable = {}  # (hemisphere, month 0-11, hour 0-23) -> records
+        self.leaving = {}  # (hemisphere, month 0-11) -> records available that month but not the next
+        for hemisphere, months in self.months.items():
+            for month in range(12):
+                this_month = [name for name in by_price if months[name] >> month & 1]
+                for hour in range(24):
+                    self.catchable[hemisphere, month, hour] = \
+                        [self.fish[name] for name in this_month if self.hours[name] >> hour & 1]
+                self.leaving[hemisphere, month] = \
+                    [self.fish[name] for name in this_month if not months[name] >> (month + 1) % 12 & 1]
+
+    def __len__(self):
+        return len(self.fish)
+
+    @staticmethod
+    def price(record):
+        digits = re.sub(r'\D', '', record['price'])
+        return int(digits) if digits else 0
+
+    @staticmethod
+    def month_mask(available):
+        return sum(1 << month for month, ok in enumerate(available) if ok)
+
+    @staticmethod
+    def hour_mask(text):
+        """Turns times like "4 AM - 9 PM & 9 PM - 4 AM" into a bitmask of hours. Anything else means all day."""
+        mask = 0
+        for start, start_half, end, end_half in FishIndex.hour_range.findall(text):
+            start = int(start) % 12 + (12 if start_half.upper() == 'PM' else 0)
+            end = int(end) % 12 + (12 if end_half.upper() == 'PM' else 0)
+            hour = start
+            while hour != end:  # Wraps around midnight
+                mask |= 1 << hour
+                hour = (hour + 1) % 24
+        return mask or 0xffffff
+
+    @staticmethod
+    def hemisphere(text):
+        """Returns north or south for a hemisphere the way someone might type it, or None."""
+        return FishIndex.hemispheres.get(text.lower())
+
+    def find(self, query):
+        """Returns the fish matching query best, or None. Tries the exact name, then the start of the name or of
+        any word in it (so "shark" finds the great white shark), then names spelled almost the same."""
+        query = FishStore.normalize(query)
+        if not query:
+            return None
+        if query in self.fish:
+            return self.fish[query]
+        i = bisect.bisect_left(self.names, query)
+        if i < len(self.names) and self.names[i].startswith(query):
+            return self.fish[self.names[i]]
+        i = bisect.bisect_left(self.words, (query,))
+        if i < len(self.words) and self.words[i][0].startswith(query):
+            return self.fish[self.words[i][1]]
+        close = difflib.get_close_matches(query, self.names, n=1)
+        return self.fish[close[0]] if close else None
+
+
+class FishStore:
+    """Structured AC:NH fish data, parsed once from the wiki and indexed by name.
+
+    The parsed records are persisted to disk, so a restart doesn't need the network. After ttl seconds the
+    store checks the page's latest revision ID and only downloads and parses the page again if it changed."""
+
+    api_url = 'https://animalcrossing.fandom.com/api.php'
+    page = 'Fish_(New_Horizons)'
+    content_params = {'action': 'query', 'prop': 'revisions', 'rvprop': 'ids|content', 'rvslots': '*',
+                      'format': 'json', 'titles': page}
+    revid_params = {'action': 'query', 'prop': 'revisions', 'rvprop': 'ids', 'format': 'json', 'titles': page}
+    html_params = {'action': 'parse', 'page': page, 'prop': 'text', 'format': 'json'}
+    months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.revid = None
+        self.fetched = 0
+        self.fish = FishIndex([])
+        self.lock = asyncio.Lock()
+        self.load()
+
+    @staticmethod
+    def normalize(name):
+        return ' '.join(name.lower().split())
+
+    @staticmethod
+    def clean(param):
+        """Strips wiki markup from a template parameter. [[Link|Text]] becomes Text."""
+        text = str(param.value).strip(' \n[]')
+        return text.split('|')[-1].strip()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.revid, self.fetched = saved['revid'], saved['fetched']
+        self.index(saved['fish'])
+        log.info(f'Loaded {len(self.fish)} fish from {self.path}.')
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'revid': self.revid, 'fetched': self.fetched, 'fish': list(self.fish.fish.values())}, f)
+        os.replace(tmp_path, self.path)
+
+    def index(self, records):
+        self.fish = FishIndex(records)
+
+    async def get(self, name, web):
+        """Returns the record for the fish best matching name (see FishIndex.find), or None."""
+        await self.refresh(web)
+        return self.fish.find(name)
+
+    async def catchable(self, web, hemisphere, month, hour):
+        """Returns the fish catchable in a hemisphere at a month (0-11) and hour (0-23), most valuable first."""
+        await self.refresh(web)
+        return self.fish.catchable[hemisphere, month, hour]
+
+    async def leaving(self, web, hemisphere, month):
+        """Returns the fish that can be caught in month (0-11) but not the month after, most valuable first."""
+        await self.refresh(web)
+        return self.fish.leaving[hemisphere, month]
+
+    async def refresh(self, web, force=False):
+        """Makes sure the data is at most ttl seconds old. Only one refresh runs at a time."""
+        if not force and self.fish and time.time() - self.fetched < self.ttl:
+            return
+        async with self.lock:
+            if not force and self.fish and time.time() - self.fetched < self.ttl:
+                return  # Someone else refreshed while we waited
+            try:
+                await self.update(web, force)
+            except Exception as e:
+                if not self.fish:
+                    raise
+                log.warning('Failed to refresh fish data, using what we have.', str(e))
+
+    async def update(self, web, force=False):
+        """Downloads and parses the wiki page if it changed since the last time."""
+        loop = asyncio.get_event_loop()
+        if not force and self.revid is not None:
+            pages = (await web.get_json(FishStore.api_url, params=FishStore.revid_params))['query']['pages']
+            if next(iter(pages.values()))['revisions'][0]['revid'] == self.revid:
+                self.fetched = time.time()
+                await loop.run_in_executor(None, self.save)
+                return
+
+        pages = (await web.get_json(FishStore.api_url, params=FishStore.content_params))['query']['pages']
+        revision = next(iter(pages.values()))['revisions'][0]
+        html = (await web.get_json(FishStore.api_url, params=FishStore.html_params))['parse']['text']['*']
+
+        # Parsing the whole page takes a while, so keep it off the event loop.
+        records = await loop.run_in_executor(None, FishStore.parse, revision['*'], html)
+        self.index(records)
+        self.revid = revision['revid']
+        self.fetched = time.time()
+        await loop.run_in_executor(None, self.save)
+        log.info(f'Parsed {len(self.fish)} fish from revision {self.revid}.')
+
+    @staticmethod
+    def parse(wikitext, html):
+        """Turns the wiki page into a list of fish records, merging the north and south hemisphere tables."""
+        templates = mwp.parse(wikitext).filter_templates()
+        filtered_list = [t for t in templates if t.name.matches('TableContent') or t.name.matches('roundyR')]
+
+        # Remove first roundyR. The second one separates north and south hemispheres.
+        roundy_r = filtered_list.pop(0)
+        idx = filtered_list.index(roundy_r)
+        n_hemisphere = filtered_list[:idx]
+        s_hemisphere = filtered_list[idx + 1:]
+
+        records = {}
+        for template in n_hemisphere:
+            params = template.params
+            name = FishStore.clean(params[1])
+            icon_name = FishStore.clean(params[2]).replace('File:', '').strip().replace(' ', '_')
+            pic = re.search(f'href="(?P<URL>[^"]*?{re.escape(icon_name)}[^"]*?)"', html)
+            records[FishStore.normalize(name)] = {
+                'name': name,
+                'icon_url': pic.group('URL') if pic else None,
+                'price': FishStore.clean(params[3]),
+                'location': FishStore.clean(params[4]),
+                'shadow_size': FishStore.clean(params[5]),
+                'time': re.sub('<.*?>', '', str(params[6].value)).strip(' \n'),
+                'north': [str(p.value).strip(' \n') == '✓' for p in params[7:19]],
+                'south': None,
+            }
+        for template in s_hemisphere:
+            record = records.get(FishStore.normalize(FishStore.clean(template.params[1])))
+            if record is not None:
+                record['south'] = [str(p.value).strip(' \n') == '✓' for p in template.params[7:19]]
+        return list(records.values())
+
+    @staticmethod
+    def format_months(available):
+        if all(available):
+            return 'All year'
+        return ', '.join(month for month, ok in zip(FishStore.months, available) if ok)
@@ -0,0 +1,132 @@
+"""Runs Alfred as several worker processes on one machine, each handling its own range of shards.
+Every worker has its own event loop (and GIL), so music in busy guilds can't slow down commands elsewhere.
+Run from src/ with: python launcher.py"""
+import multiprocessing
+import os
+import signal
+import time
+
+import configloader as cfload
+import requests
+from logger import Logger as log
+
+
+def recommended_shards(token):
+    """Asks Discord how many shards the bot should use."""
+    response = requests.get('https://discord.com/api/v7/gateway/bot', headers={'Authorization': f'Bot {token}'},
+                            timeout=10)
+    response.raise_for_status()
+    return response.json()['shards']
+
+
+def split_shards(shard_count, workers):
+    """Splits the shards into contiguous, evenly sized ranges, one per worker."""
+    return [list(range(i * shard_count // workers, (i + 1) * shard_count // workers)) for i in range(workers)]
+
+
+def worker_main(index, shard_ids, shard_count, cluster_status, restart_requests):
+    import main
+    main.run(shard_ids=shard_ids, shard_count=shard_count, worker=index,
+             cluster_status=cluster_status, restart_requests=restart_requests)
+
+
+class Supervisor:
+    """Starts the workers, restarts any that crash (or are asked to restart with /restartworker),
+    and shares a status dict that every worker writes its shard status to."""
+
+    poll_interval = 1
+    stop_timeout = 30  # Seconds a worker gets to disconnect cleanly before it's killed
+    max_restart_delay = 300
+
+    def __init__(self, shard_count, workers):
+        self.shard_count = shard_count
+        self.shards = split_shards(shard_count, workers)
+        # Spawn instead of fork, so workers don't inherit this process' logging thread.
+        self.context = multiprocessing.get_context('spawn')
+        self.manager = self.context.Manager()
+        self.cluster_status = self.manager.dict()
+        self.restart_requests = self.manager.dict()
+        self.processes = {}
+        self.crashes = {}  # worker -> crashes in a row, for backoff
+        self.scheduled = {}  # worker -> time to restart a crashed worker at
+        self.stopping = False
+
+    def start_worker(self, index):
+        os.environ['ALFRED_WORKER'] = str(index)
+        process = self.context.Process(target=worker_main, name=f'alfred-worker-{index}',
+                                       args=(index, self.shards[index], self.shard_count,
+                                             self.cluster_status, self.restart_requests))
+        process.start()
+        self.processes[index] = process
+        log.info(f'Started worker {index} (pid {process.pid}) with shards {self.shards[index]}.')
+
+    def stop_worker(self, index):
+        """Asks a worker to log out (discord.py closes cleanly on SIGTERM), and kills it if it doesn't."""
+        process = self.processes.pop(index)
+        process.terminate()
+        process.join(Supervisor.stop_timeout)
+        if process.is_alive():
+            log.warning(f'Worker {index} did not stop in time, killing it.')
+            process.kill()
+            process.join()
+        self.cluster_status.pop(index, None)
+
+    def restart_worker(self, index):
+        log.info(f'Restarting worker {index}...')
+        self.stop_worker(index)
+        self.start_worker(index)
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.forward_reload)
+        for index in range(len(self.shards)):
+            self.start_worker(index)
+
+        while (self.processes or self.scheduled) and not self.stopping:
+            time.sleep(Supervisor.poll_interval)
+            for index, process in list(self.processes.items()):
+                if self.restart_requests.pop(index, False):
+                    self.crashes.pop(index, None)
+                    self.restart_worker(index)
+                elif not process.is_alive():
+                    self.handle_exit(index, process)
+            for index, when in list(self.scheduled.items()):
+                if time.time() >= when:
+                    del self.scheduled[index]
+                    self.start_worker(index)
+
+        for index in list(self.processes):
+            self.stop_worker(index)
+        self.manager.shutdown()
+
+    def handle_exit(self, index, process):
+        del self.processes[index]
+        self.cluster_status.pop(index, None)
+        if process.exitcode == 0:  # /shutdown
+            log.info(f'Worker {index} shut down.')
+            return
+        crashes = self.crashes.get(index, 0)
+        delay = min(2 ** crashes, Supervisor.max_restart_delay)
+        self.crashes[index] = crashes + 1
+        log.error(f'Worker {index} exited with code {process.exitcode}, restarting in {delay} s.')
+        self.scheduled[index] = time.time() + delay
+
+    def request_stop(self, signum, frame):
+        self.stopping = True
+
+    def forward_reload(self, signum, frame):
+        """Passes SIGUSR1 (reload the cogs, see deploy/update.sh) on to every worker."""
+        for index, process in self.processes.items():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGUSR1)
+        log.info(f'Asked {len(self.processes)} workers to reload their cogs.')
+
+
+if __name__ == '__main__':
+    settings = cfload.load('../config.ini')
+    shard_count = settings.sharding.shard_count or recommended_shards(settings.startup.token)
+    workers = min(settings.sharding.workers, shard_count)
+    log.info(f'Launching {workers} workers for {shard_count} shards.')
+    Supervisor(shard_count, workers).run()
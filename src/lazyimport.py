@@ -0,0 +1,42 @@
+import asyncio
+import importlib
+import threading
+import time
+
+from logger import Logger as log
+
+
+class LazyModule:
+    """Stands in for a slow-to-import module (youtube_dl, praw, ...) until one of its attributes is used.
+
+    Cogs can then be loaded without paying for their dependencies, which get imported the first time a command
+    needs them, or by warm() in the background once the bot is connected. Importing is thread-safe, so it's
+    fine (and better) to touch a lazy module for the first time from an executor thread."""
+
+    modules = []
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+        self.lock = threading.Lock()
+        LazyModule.modules.append(self)
+
+    def load(self):
+        if self.module is None:
+            with self.lock:
+                if self.module is None:
+                    start = time.perf_counter()
+                    self.module = importlib.import_module(self.name)
+                    log.info(f'Imported {self.name} in {(time.perf_counter() - start) * 1000:.0f} ms.')
+        return self.module
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    @classmethod
+    async def warm(cls):
+        """Imports every lazy module that hasn't been used yet, one at a time on an executor thread."""
+        loop = asyncio.get_event_loop()
+        for module in cls.modules:
+            if module.module is None:
+                await loop.run_in_executor(None, module.load)
@@ -1,56 +1,148 @@
+import atexit
+import dataclasses
 import datetime
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+
+class LazyMessage:
+    """Joins the message parts only if a handler actually formats the record."""
+
+    __slots__ = ('parts',)
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def __str__(self):
+        return ' '.join(str(part) for part in self.parts)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread as they are. The stock QueueHandler formats
+    the message on the caller's thread, which is exactly what we're trying to avoid."""
+
+    def prepare(self, record):
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    """The classic format, plus the guild and command when a record has them."""
+
+    def format(self, record):
+        text = super().format(record)
+        context = [f'{key}={getattr(record, key)}' for key in ('guild_id', 'command') if getattr(record, key, None)]
+        return f'{text} [{", ".join(context)}]' if context else text
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, for log tooling."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in ('guild_id', 'command'):
+            if getattr(record, key, None) is not None:
+                entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
 
 
 class Logger:
+    """Logs to a rotating file and the console.
+    Callers only put records on a queue; formatting and I/O happen on the QueueListener's thread."""
 
     logger = None
+    listener = None
+    settings = None  # The LoggingSettings last applied by configure()
     output_logs = True
+    date = datetime.datetime.now().strftime('%Y-%m-%d-%H.%M.%S')  # TODO clean up
+    if 'ALFRED_WORKER' in os.environ:  # Set by launcher.py, so worker processes don't share a file
+        date += f'-worker{os.environ["ALFRED_WORKER"]}'
+    log_format = '[%(levelname)s] (%(asctime)s) - %(message)s'
 
     @classmethod
-    def setup_logger(cls):
-        log_format = '[%(levelname)s] (%(asctime)s) - %(message)s'  # TODO add guild ID
-        date = datetime.datetime.now().strftime('%Y-%m-%d-%H.%M.%S')  # TODO clean up
-        logging.basicConfig(filename=f'../logs/{date}.log',
-                            level=logging.INFO,  # specify in config.ini?
-                            format=log_format,
-                            filemode='w')
+    def setup_logger(cls, level=logging.INFO, structured=False, max_bytes=10 * 2**20, backup_count=5):
+        cls.stop()
+
+        formatter = JSONFormatter() if structured else TextFormatter(Logger.log_format)
+        os.makedirs('../logs', exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(f'../logs/{cls.date}.log', maxBytes=max_bytes,
+                                                            backupCount=backup_count)
+        file_handler.setFormatter(formatter)
+        handlers = [file_handler]
+        if cls.output_logs:
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(TextFormatter('%(message)s'))
+            handlers.append(console_handler)
+
+        log_queue = queue.Queue()
         cls.logger = logging.getLogger()
+        cls.logger.handlers = [DeferredQueueHandler(log_queue)]
+        cls.logger.setLevel(level)
+        cls.listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        cls.listener.start()
         cls.logger.info('Logger set up successfully.')
 
     @classmethod
-    def debug(cls, *msg):  # TODO review this logging style
-        for m in msg:
-            cls.logger.debug(m)
-        if cls.output_logs:  # TODO This is jank. Fix at some point
-            print(' '.join(msg))
+    def stop(cls):
+        """Flushes everything still queued and stops the listener thread."""
+        if cls.listener is not None:
+            cls.listener.stop()
+            for handler in cls.listener.handlers:
+                handler.close()
+            cls.listener = None
 
     @classmethod
-    def info(cls, *msg):
-        for m in msg:
-            cls.logger.info(m)
-        if cls.output_logs:
-            print(' '.join(msg))
+    def configure(cls, settings):
+        """Applies the [Logging] section of config.ini (configloader.LoggingSettings).
+        Called on every config reload, so the listener thread and file are only replaced if they have to be."""
+        if settings == cls.settings:
+            return
+        if cls.settings is not None and dataclasses.replace(cls.settings, level=settings.level) == settings:
+            cls.logger.setLevel(settings.level)
+        else:
+            cls.setup_logger(level=settings.level, structured=settings.format == 'json',
+                             max_bytes=settings.max_bytes, backup_count=settings.backup_count)
+        cls.settings = settings
 
     @classmethod
-    def warning(cls, *msg):
-        for m in msg:
-            cls.logger.warning(m)
-        if cls.output_logs:
-            print(' '.join(msg))
+    def log(cls, level, msg, ctx=None, guild_id=None, command=None):
+        # Checked first, so disabled calls never build a record.
+        if not cls.logger.isEnabledFor(level):
+            return
+        if ctx is not None:
+            guild_id = guild_id or (ctx.guild.id if ctx.guild else None)
+            command = command or (ctx.command.qualified_name if ctx.command else None)
+        cls.logger.log(level, LazyMessage(msg), extra={'guild_id': guild_id, 'command': command})
 
     @classmethod
-    def error(cls, *msg):
-        for m in msg:
-            cls.logger.error(m)
-        if cls.output_logs and type(msg) is str:
-            print(' '.join(msg))
+    def debug(cls, *msg, **context):
+        cls.log(logging.DEBUG, msg, **context)
 
     @classmethod
-    def critical(cls, *msg):
-        for m in msg:
-            cls.logger.critical(m)
-        if cls.output_logs:
-            print(' '.join(msg))
+    def info(cls, *msg, **context):
+        cls.log(logging.INFO, msg, **context)
+
+    @classmethod
+    def warning(cls, *msg, **context):
+        cls.log(logging.WARNING, msg, **context)
+
+    @classmethod
+    def error(cls, *msg, **context):
+        cls.log(logging.ERROR, msg, **context)
+
+    @classmethod
+    def critical(cls, *msg, **context):
+        cls.log(logging.CRITICAL, msg, **context)
 
 Logger.setup_logger()
+atexit.register(Logger.stop)
@@ -1,40 +1,153 @@
-from discord.ext import commands
+import signal
+import sys
+import time
+
+from discord.ext import commands, tasks
 import configloader as cfload
+from cpujobs import CPUJobs
+from lazyimport import LazyModule
 from logger import Logger as log
+from triggers import TriggerEngine, react
+from webclient import WebClient
 
-log.info('Reading config data...')
-cfload.read('../config.ini')
 
-#######################    Begin Loading Process   ################################
-startup_extensions = cfload.configSectionMap('Startup')['startup_extensions'].split()
-command_prefix = cfload.configSectionMap('Commands')['command_prefix']
+def get_prefix(bot, message):
+    # Read on every message so a changed prefix applies without a restart.
+    return commands.when_mentioned_or(cfload.settings.commands.command_prefix)(bot, message)
 
-bot = commands.Bot(command_prefix=commands.when_mentioned_or(command_prefix), description=cfload.configSectionMap('Startup')['description'])
 
-# Load extensions
-if __name__ == '__main__':
+class Alfred(commands.AutoShardedBot):
+    """The bot, plus resources shared by every cog.
+    When run by launcher.py, this process only handles the shards in shard_ids
+    and reports its status to the other workers through cluster_status."""
+
+    def __init__(self, *args, worker=None, cluster_status=None, restart_requests=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.worker = worker
+        self.cluster_status = cluster_status
+        self.restart_requests = restart_requests
+        self.warmed = False
+        # One pooled HTTP session for every cog instead of a new connection per request.
+        http = cfload.settings.http
+        self.web = WebClient(limit_per_host=http.limit_per_host, timeout=http.timeout, retries=http.retries)
+        # Worker processes for CPU-heavy commands, so they don't hold up every other guild.
+        cpu = cfload.settings.cpu
+        self.cpu = CPUJobs(workers=cpu.workers, max_pending=cpu.max_pending, per_user=cpu.per_user)
+        # Auto-reactions to plain messages. Servers can turn them off with /trigger.
+        self.triggers = TriggerEngine('../cache/triggers.json')
+        self.triggers.add('greeting', ('HELLO', 'HI', 'HEY', 'GREETINGS', 'SALUTATIONS', 'YO'),
+                          react('\U0001F44B'))  # Waving hand
+
+    def status(self):
+        """Summarizes this process for the shared status view."""
+        music = self.get_cog('Music')
+        players = type(music).players.values() if music is not None else ()
+        shards = {}
+        for shard_id, latency in self.latencies:
+            shards[shard_id] = {'latency': latency, 'guilds': 0, 'players': 0}
+        for guild in self.guilds:
+            if guild.shard_id in shards:
+                shards[guild.shard_id]['guilds'] += 1
+        for player in players:
+            if player.shard_id in shards:
+                shards[player.shard_id]['players'] += 1
+        return {'shards': shards, 'voice_clients': len(self.voice_clients)}
+
+    @tasks.loop(seconds=15)
+    async def report_status(self):
+        self.cluster_status[self.worker] = self.status()
+
+    @report_status.before_loop
+    async def before_report_status(self):
+        await self.wait_until_ready()
+
+    async def reload_extensions(self, names=None):
+        """Reloads extensions (all of them by default) without reconnecting to Discord.
+        A failed reload leaves the old version loaded. Returns the names that failed."""
+        failed = []
+        for name in names or list(self.extensions):
+            start = time.perf_counter()
+            try:
+                self.reload_extension(name)
+                log.info(f'Extension \'{name}\' reloaded in {(time.perf_counter() - start) * 1000:.0f} ms.')
+            except Exception as e:
+                log.error(f'Failed to reload {name}:', e)
+                failed.append(name)
+        return failed
+
+    async def close(self):
+        # Unloading runs every cog's cleanup, which is also when Music saves what's playing
+        for name in list(self.extensions):
+            try:
+                self.unload_extension(name)
+            except Exception as e:
+                log.error(f'Failed to unload {name}:', e)
+        await self.web.close()
+        self.cpu.shutdown()
+        await super().close()
+
+
+def load_config():
+    log.info('Reading config data...')
+    try:
+        settings = cfload.load('../config.ini')
+    except cfload.ConfigError as e:
+        log.critical(e)
+        sys.exit(1)
+    log.configure(settings.logging)
+    cfload.listeners.append(lambda new_settings: log.configure(new_settings.logging))
+    return settings
+
+
+def create_bot(settings, **kwargs):
+    #######################    Begin Loading Process   ################################
+    started_at = time.perf_counter()
+    bot = Alfred(command_prefix=get_prefix, description=settings.startup.description, **kwargs)
+
+    # Load extensions. Their heavy dependencies are lazy (see lazyimport.py), so this should be quick.
     log.info('\nLoading extensions...')
-    for extension in startup_extensions:
+    for extension in settings.startup.startup_extensions:
+        start = time.perf_counter()
         try:
             bot.load_extension(extension)
-            log.info(f'Extension \'{extension}\' loaded.')
+            log.info(f'Extension \'{extension}\' loaded in {(time.perf_counter() - start) * 1000:.0f} ms.')
         except Exception as e:
             log.critical(f'Failed to load {extension} extension.')
             log.critical(e)
 
-@bot.event
-async def on_ready():
-    log.info('\nConnected to Discord as', bot.user.name, '- ID ', str(bot.user.id))
-    log.info('Alfred loaded successfully.\n______________________________\n')
-
-@bot.event
-async def on_message(message):
-    await bot.process_commands(message)
-    if message.author == bot.user and message.content.startswith(command_prefix):
-        return
-    # Magically checks for any of the greetings in message and waves
-    if not set(message.content.upper().split(' ')).isdisjoint(('HELLO', 'HI', 'HEY', 'GREETINGS', 'SALUTATIONS', 'YO')):
-        await message.add_reaction('\U0001F44B')  # Waving hand
-
-###################################################################################
-bot.run(cfload.configSectionMap('Startup')['token'])
+    @bot.event
+    async def on_ready():
+        log.info('\nConnected to Discord as', bot.user.name, '- ID ', str(bot.user.id), '- shards', str(bot.shard_ids))
+        log.info(f'Alfred loaded successfully in {time.perf_counter() - started_at:.1f} s.\n______________________________\n')
+        if not bot.warmed:  # on_ready fires again after reconnecting
+            bot.warmed = True
+            # Import whatever the commands will need before someone uses them
+            await LazyModule.warm()
+
+    @bot.event
+    async def on_message(message):
+        # Runs for every message in every guild, so bail out as early as possible
+        if message.author.bot:
+            return
+        await bot.process_commands(message)
+        await bot.triggers.handle(message, cfload.settings.commands.command_prefix)
+
+    ###################################################################################
+    return bot
+
+
+def run(shard_ids=None, shard_count=None, worker=None, cluster_status=None, restart_requests=None):
+    """Runs the bot. With no shard arguments, one process handles every shard Discord recommends."""
+    settings = load_config()
+    bot = create_bot(settings, shard_ids=shard_ids, shard_count=shard_count, worker=worker,
+                     cluster_status=cluster_status, restart_requests=restart_requests)
+    bot.loop.create_task(cfload.watch())
+    if hasattr(signal, 'SIGUSR1'):  # deploy/update.sh sends this when only cogs changed
+        bot.loop.add_signal_handler(signal.SIGUSR1, lambda: bot.loop.create_task(bot.reload_extensions()))
+    if cluster_status is not None:
+        bot.report_status.start()
+    bot.run(settings.startup.token)
+
+
+if __name__ == '__main__':
+    run()
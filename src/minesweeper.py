@@ -0,0 +1,60 @@
+from lazyimport import LazyModule
+
+np = LazyModule('numpy')
+
+message_limit = 2000  # Discord's maximum message length
+max_messages = 5  # Bigger boards are refused instead of flooding the channel
+
+# Keycap emoji for 0-8, then the bomb. A cell's token is tokens[count], or tokens[9] for a mine.
+tokens = [f'{n}\uFE0F\u20E3' for n in range(9)] + ['\U0001F4A3']
+spoiler_tokens = [f'||{t}||' for t in tokens]
+
+
+def check_size(width, height, reveal=False):
+    """Raises ValueError if a board this size couldn't possibly fit in max_messages, without building it.
+    Every cell takes at least its shortest token plus a space, so this is cheap even for absurd sizes."""
+    cell = min(len(t) for t in (tokens if reveal else spoiler_tokens)) + 1
+    if width * cell - 1 > message_limit:
+        raise ValueError('The board is too wide to fit in a message.')
+    if width * height * cell > message_limit * max_messages:
+        raise ValueError(f'The board is too big, it would take more than {max_messages} messages.')
+
+
+def generate(width, height, mines, rng=None):
+    """Returns a height x width array where each cell is the number of neighbouring mines, or 9 for a mine."""
+    if not 0 < mines <= width * height:
+        raise ValueError(f'A {width}x{height} board fits between 1 and {width * height} mines.')
+
+    # Sampling without replacement picks every mine in one go, however full the board is.
+    if rng is None:
+        rng = np.random
+    is_mine = np.zeros(width * height, dtype=bool)
+    is_mine[rng.choice(width * height, size=mines, replace=False)] = True
+    is_mine = is_mine.reshape(height, width)
+
+    # Convolve with a 3x3 kernel of ones: sum the 9 shifted copies of the zero-padded board.
+    padded = np.pad(is_mine.astype(np.uint8), 1)
+    counts = sum(padded[dy:dy + height, dx:dx + width] for dy in range(3) for dx in range(3))
+    return np.where(is_mine, 9, counts)
+
+
+def render(board, reveal=False, title='Minesweeper:'):
+    """Renders a board as one or more messages that each fit in Discord's length limit.
+    Rows are never split across messages."""
+    lookup = tokens if reveal else spoiler_tokens
+    rows = [' '.join([lookup[cell] for cell in row]) for row in board.tolist()]
+
+    messages, current, length = [], [title], len(title)
+    for row in rows:
+        if len(row) > message_limit:
+            raise ValueError('The board is too wide to fit in a message.')
+        if length + 1 + len(row) > message_limit:
+            messages.append('\n'.join(current))
+            current, length = [], -1
+        current.append(row)
+        length += 1 + len(row)
+    messages.append('\n'.join(current))
+
+    if len(messages) > max_messages:
+        raise ValueError(f'The board would take {len(messages)} messages, the maximum is {max_messages}.')
+    return messages
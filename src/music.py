@@ -1,9 +1,22 @@
-from collections import deque
-
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import configloader as cfload
 import discord
-from discord.ext import commands
+from audio import MeteredAudio, TrackDeck, create_audio
+from discord.ext import commands, tasks
+from lazyimport import LazyModule
 from logger import Logger as log
-from youtube_dl import YoutubeDL
+from musiccache import MusicCache
+from querycache import QueryCache
+
+youtube_dl = LazyModule('youtube_dl')  # Only ever used on the executor, so it's imported there too
 
 
 class MusicActivity:
@@ -16,18 +29,17 @@ class MusicActivity:
         PAUSED = 2
         STOPPED = 3
 
-    def __init__(self, bot):
-        self.bot = bot
+    def __init__(self, presence):
+        self.presence = presence
         self.activity = discord.Activity()
 
-    async def change_act(self, status, source=None):
+    def change_act(self, status, source=None):
         if status == MusicActivity.Status.PLAYING:
             self.playing(source)
         elif status == MusicActivity.Status.STOPPED:
             self.activity = discord.Activity()  # Resets activity
 
-        await self.bot.change_presence(activity=self.activity)
-        log.debug('Updated bot presence.')
+        self.presence.request()  # The scheduler sends it when the gateway allows
 
     def playing(self, source):
         self.activity.type = discord.ActivityType.listening
@@ -35,7 +47,65 @@ class MusicActivity:
         # self.activity.details = "test details section" # Doesn't work with the current Discord API
 
 
+class PresenceScheduler:
+    """Sets the bot's presence from every player's MusicActivity.
+    Presence is shared by every guild and rate limited by the gateway, so changes are coalesced
+    and sent at most once per [Music] presence_interval, however many guilds change songs.
+    When several guilds are playing, the presence rotates between them."""
+
+    def __init__(self, bot, players):
+        self.bot = bot
+        self.players = players
+        self.changed = asyncio.Event()
+        self.sent = None  # (type, name) of the presence Discord currently shows
+        self.rotation = 0
+        self.sends = 0
+        self.task = None
+
+    def request(self):
+        """Marks the presence as out of date. Cheap, so call it on every change."""
+        self.changed.set()
+        if self.task is None or self.task.done():
+            self.task = self.bot.loop.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def pick(self):
+        """Picks the activity to show: one of the playing guilds, taking turns."""
+        playing = [p.activity.activity for p in self.players.values() if p.activity.activity.name]
+        if not playing:
+            return None
+        return playing[self.rotation % len(playing)]
+
+    async def run(self):
+        await self.bot.wait_until_ready()
+        while True:
+            try:
+                await asyncio.wait_for(self.changed.wait(), cfload.settings.music.presence_rotate_seconds)
+            except asyncio.TimeoutError:
+                self.rotation += 1  # Nothing changed for a while, show another guild's song
+            self.changed.clear()
+
+            activity = self.pick()
+            key = (activity.type, activity.name) if activity is not None else None
+            if key != self.sent:
+                try:
+                    await self.bot.change_presence(activity=activity)
+                    self.sent = key
+                    self.sends += 1
+                    log.debug('Updated bot presence.')
+                except Exception as e:
+                    log.error('Failed to update presence:', e)
+            # Changes that come in meanwhile are all picked up by the next pass
+            await asyncio.sleep(cfload.settings.music.presence_interval)
+
+
 class YTDLSource:  # TODO subclass to PCMVolumeTransformer? (like that noob in the help server did)
+    """A song in a queue. Only keeps the few fields playback needs, since a guild can queue hundreds of them."""
+
+    __slots__ = ('query', 'data', 'path', 'download_task', 'resolved', 'resolve_task', 'start_at')
 
     ytdl_opts = {
         'default_search': 'auto',
@@ -44,60 +114,416 @@ class YTDLSource:  # TODO subclass to PCMVolumeTransformer? (like that noob in t
         # 'logger' : 'the logger'
         'format': 'bestaudio/best',
         'restrictfilenames': True,
-        'outtmpl': '../music_cache/%(extractor)s-%(title)s.%(ext)s',  # %(title)s.%(ext)s',
+        'outtmpl': '../music_cache/%(extractor)s-%(id)s.%(ext)s',  # Keyed by ID so the cache can find it again
     }
 
-    def __init__(self, query):
-        self.query = ' '.join(query)
-        self.data = {}
+    # youtube_dl is blocking, so all extraction and downloading happens on this pool.
+    # It's bounded so a burst of /play commands can't spawn an unbounded number of downloads.
+    # The pool and the caches are shut down with the cog, so each Music instance sets up its own.
+    executor = None
+    cache = None
+    queries = None
+
+    # Lets FFmpeg survive dropped connections while streaming.
+    stream_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+
+    # The full extract_info dict (every format, thumbnail, subtitle...) is tens of KB, so songs only keep these.
+    kept_fields = ('id', 'extractor', 'title', 'webpage_url', 'duration', 'url', 'ext', 'acodec')
+    # The last few full dicts are kept for download(), so the next songs don't have to be extracted twice.
+    full_info = OrderedDict()  # webpage_url -> extract_info dict
+    full_info_size = 16
+    full_info_lock = threading.Lock()  # Used from the executor threads
+
+    def __init__(self, query, data, resolved=True):
+        self.query = query
+        self.data = data
+        self.path = None
+        self.download_task = None
+        # Playlist entries start out with just a title and URL. The full metadata (with the stream URL)
+        # is only fetched once the song gets close to the front of the queue.
+        self.resolved = resolved
+        self.resolve_task = None
+        self.start_at = 0.  # Seconds into the song to start playing, when resuming it
 
-        with YoutubeDL(YTDLSource.ytdl_opts) as ydl:
-            info = ydl.extract_info(self.query, download=False)
-            if 'entries' in info:  # grab the first video
-                info = info['entries'][0]
+    @classmethod
+    async def create(cls, query, loop):
+        """Resolves the metadata for a query off the event loop.
+        Returns as soon as the metadata is known, so the source can be enqueued right away.
+        The player starts the download shortly before the song's turn comes (see MusicPlayer.prebuffer)."""
+        query = ' '.join(query)
+        data = await cls.queries.resolve(query, cls.extract_info, loop, cls.executor)
+        # A cached query whose media URL has expired gets a fresh one when it's close to the front, like playlist songs
+        source = cls(query, data, resolved='url' in data)
+        if cls.cache.contains(data):
+            source.prefetch(loop)  # Nothing to download, just look up the path
+        return source
 
-            if not info['is_live']:
-                self.data = ydl.extract_info(self.query)  # TODO run in executor?
-            else:
-                pass  #TODO get next video
+    @classmethod
+    async def playlist(cls, url, loop):
+        """Lists the songs in a playlist with a single flat extraction. The songs aren't resolved yet."""
+        info = await loop.run_in_executor(cls.executor, cls.extract_flat, url)
+        return [cls.from_flat(entry) for entry in info.get('entries') or [info] if entry]
 
-            if 'entries' in self.data:  # if we get a playlist, grab the first video TODO does ytdl_opts['noplaylist'] prevent this error?
-                self.data = self.data['entries'][0]
-            self.path = ydl.prepare_filename(self.data)
+    @classmethod
+    def extract_flat(cls, url):
+        """Gets the entries of a playlist without extracting each video. Blocking."""
+        with youtube_dl.YoutubeDL(dict(cls.ytdl_opts, noplaylist=False, extract_flat='in_playlist')) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    @classmethod
+    def from_flat(cls, entry):
+        url = entry.get('webpage_url') or entry['url']
+        if '://' not in url and entry.get('ie_key') == 'Youtube':  # Some versions only give the ID
+            url = f'https://www.youtube.com/watch?v={url}'
+        return cls(url, {'title': entry.get('title') or url, 'webpage_url': url,
+                         'duration': entry.get('duration')}, resolved=False)
+
+    def snapshot(self, position=0.):
+        """Returns what's needed to queue this song again after a restart."""
+        return {'webpage_url': self.data.get('webpage_url') or self.query, 'title': self.data.get('title'),
+                'duration': self.data.get('duration'), 'start_at': position}
+
+    @classmethod
+    def restore(cls, track):
+        """Recreates a song from a snapshot. Like playlist entries, it's only resolved when its turn gets close,
+        since stream URLs expire."""
+        source = cls.from_flat(track)
+        source.start_at = track['start_at']
+        return source
+
+    def memory(self):
+        """Roughly how many bytes this song takes up."""
+        return sys.getsizeof(self) + sys.getsizeof(self.data) + sum(sys.getsizeof(v) for v in self.data.values())
+
+    def resolve(self, loop):
+        """Fetches the full metadata in the background if we only have a playlist entry so far.
+        Returns a future that resolves to the metadata."""
+        if self.resolve_task is None:
+            self.resolve_task = loop.create_task(self._resolve(loop))
+        return self.resolve_task
+
+    async def _resolve(self, loop):
+        if not self.resolved:
+            self.data = await YTDLSource.queries.resolve(self.data.get('webpage_url') or self.query,
+                                                         YTDLSource.extract_info, loop, YTDLSource.executor,
+                                                         need_url=True)
+            self.resolved = True
+        return self.data
+
+    @property
+    def streamable(self):
+        # 'stream' plays straight from YouTube's media URL, 'download' waits for the whole file first.
+        return cfload.settings.music.playback_mode == 'stream' and bool(self.data.get('url'))
+
+    async def audio_input(self, loop):
+        """Returns the input and before_options for FFmpeg.
+        That's the direct media URL when streaming, or the downloaded file otherwise.
+        The resolve and download tasks are shared, so they're shielded from callers being cancelled
+        (like a cued song when the queue changes)."""
+        if self.download_task is None:  # Otherwise it's downloaded (or downloading) already
+            await asyncio.shield(self.resolve(loop))
+            if self.streamable and self.url_expired():  # Queued long enough ago for its URL to run out
+                self.resolved, self.resolve_task = False, None
+                await asyncio.shield(self.resolve(loop))
+            if self.streamable:
+                return self.data['url'], YTDLSource.stream_options
+        return await asyncio.shield(self.prefetch(loop)), None
+
+    def url_expired(self):
+        """Whether the media URL runs out before the song could finish playing, going by its expire parameter.
+        URLs without one are left to FFmpeg's reconnecting."""
+        expires = QueryCache.url_expires(self.data, float('inf'))
+        return expires - time.time() < QueryCache.url_margin + (self.data.get('duration') or 0)
+
+    @classmethod
+    def extract_info(cls, query):
+        """Gets the metadata of the first video matching query. Blocking."""
+        with youtube_dl.YoutubeDL(cls.ytdl_opts) as ydl:
+            info = ydl.extract_info(query, download=False)
+        if 'entries' in info:  # grab the first video
+            info = info['entries'][0]
+        if info.get('is_live'):
+            raise ValueError(f'{info["title"]} is a livestream.')  # TODO support livestreams
+        with cls.full_info_lock:
+            cls.full_info[info['webpage_url']] = info
+            if len(cls.full_info) > cls.full_info_size:
+                cls.full_info.popitem(last=False)
+        return {key: info[key] for key in cls.kept_fields if key in info}
+
+    def download(self):
+        """Downloads the audio described by self.data. Blocking."""
+        with YTDLSource.full_info_lock:
+            info = YTDLSource.full_info.pop(self.data['webpage_url'], None)
+        with youtube_dl.YoutubeDL(YTDLSource.ytdl_opts) as ydl:
+            if info is not None:
+                # Reuses the info we already extracted instead of hitting YouTube a second time.
+                ydl.process_ie_result(info, download=True)
+                return ydl.prepare_filename(info)
+            # Extracted too long ago (or the metadata came from the cache index, but the file has been evicted since).
+            info = ydl.extract_info(self.data['webpage_url'])
+            return ydl.prepare_filename(info)
+
+    def prefetch(self, loop):
+        """Starts downloading in the background if it hasn't started yet.
+        Returns a future that resolves to the path of the downloaded file."""
+        if self.download_task is None:
+            self.download_task = loop.create_task(self._download(loop))
+        return self.download_task
+
+    async def _download(self, loop):
+        if not YTDLSource.cache.contains(self.data):
+            await asyncio.shield(self.resolve(loop))
+        self.path = await YTDLSource.cache.fetch(self.data, self.download, loop, YTDLSource.executor)
+        return self.path
+
+
+class TrackQueue(asyncio.Queue):
+    """An asyncio.Queue that songs can also cut to the front of, and that /queue can look through."""
+
+    def insert_nowait(self, index, item):
+        self.put_nowait(item)
+        self._queue.pop()  # Move it from the back to index
+        self._queue.insert(index, item)
+
+    def put_front_nowait(self, item):
+        self.insert_nowait(0, item)
+
+    def peek(self):
+        return self._queue[0] if self._queue else None
+
+    def remove(self, item):
+        self._queue.remove(item)
+
+    def __iter__(self):
+        return iter(self._queue)
+
+    def __len__(self):
+        return self.qsize()
 
 
 class MusicPlayer:
-    """Controls voice clients. Each guild gets its own queue and voice client."""
+    """Controls voice clients. Each guild gets its own queue and voice client.
+    Songs are played by one asyncio task per guild (player_loop), which consumes the queue.
+    The audio thread only signals the end of a song, everything else happens on the event loop."""
 
     default_volume = 0.5
 
-    def __init__(self, bot, guild_id):
+    def __init__(self, bot, guild_id, shard_id=None):
         self.guild_id = guild_id
+        self.shard_id = shard_id  # Players live in the process that handles their guild's shard
         self.bot = bot
-        self.queue = deque()
+        self.queue = TrackQueue(maxsize=cfload.settings.music.max_queue)
         self.vc = None
         self.audio_streamer = None
         # 0-1. Default volume to preserve volume across songs.
         self.volume = MusicPlayer.default_volume
-        self.activity = MusicActivity(self.bot)
+        self.activity = MusicActivity(Music.presence)
         self.current_source = None
-
-    def music_loop(self, ctx):
-        """Streams the next YTDLSource in self.queue."""
-        # If the queue is empty, destroy the player.
-        if not self.queue:
-            self.bot.loop.create_task(self.activity.change_act(MusicActivity.Status.STOPPED, None))
-            self.bot.loop.create_task(Music.destroy_player(self.guild_id))
+        self.task = None
+        self.song_ended = asyncio.Event()
+        self.ended_at = None
+        self.prebuffering = False  # Whether the current song is close enough to its end to load the next one
+        self.gaps = deque(maxlen=50)  # Seconds of silence between recent songs
+        self.underruns = 0  # Times the audio buffer ran dry during songs that have ended
+        self.deck = None  # Every song plays through this, see TrackDeck
+        self.switched_to = None  # (source, audio) the deck moved on to by itself, for player_loop to catch up with
+        self.cue_source = None  # The next song, once it's being opened to play right after the current one
+        self.cue_task = None
+        self.last_active = time.monotonic()  # Last command or song start, for the idle reaper
+
+    def start(self):
+        """Starts the player task if it isn't running."""
+        if self.task is None or self.task.done():
+            self.task = self.bot.loop.create_task(self.player_loop())
+
+    async def player_loop(self):
+        """Plays songs until the queue runs dry, then destroys the player.
+
+        When the next song is cued in time (see cue), the deck switches to it on the audio thread and this only
+        catches up. Otherwise the deck stops after the song, and the next one is opened and played from here."""
+        while True:
+            silent_since = None  # When the previous song ended, if this one didn't follow on from it
+            if self.switched_to is not None:
+                self.current_source, self.audio_streamer = self.switched_to
+                self.switched_to = None
+                if self.current_source in self.queue:
+                    self.queue.remove(self.current_source)
+            elif self.queue.empty():
+                break
+            else:
+                self.current_source = self.queue.get_nowait()
+                self.audio_streamer = None
+                try:
+                    if self.cue_source is self.current_source:  # Opened already, but too late for the deck
+                        self.audio_streamer = await self.cue_task
+                    else:
+                        self.uncue()
+                        self.audio_streamer = await self.open_audio(self.current_source)
+                except Exception as e:
+                    log.error('Failed to load', self.current_source.query, e, guild_id=self.guild_id)
+                    continue
+                finally:
+                    self.cue_source = self.cue_task = None
+                self.deck = TrackDeck(self.audio_streamer, self.current_source, self.deck_switched,
+                                      cfload.settings.music.crossfade_ms // 20)
+                self.vc.play(self.deck, after=self.after_song)
+                silent_since = self.ended_at
+
+            self.song_ended.clear()
+            self.prebuffering = False
+            self.last_active = time.monotonic()
+            log.debug('Now playing', self.current_source.data['title'], guild_id=self.guild_id)
+
+            self.activity.change_act(MusicActivity.Status.PLAYING, self.current_source)
+            self.resolve_ahead()
+            prebuffer = self.bot.loop.create_task(self.prebuffer(self.current_source.data.get('duration')))
+            try:
+                await self.song_ended.wait()
+            finally:
+                prebuffer.cancel()
+            if self.audio_streamer.buffer is not None:
+                self.underruns += self.audio_streamer.buffer.underruns
+            if silent_since is not None and self.audio_streamer.first_frame is not None:
+                self.gaps.append(self.audio_streamer.first_frame - silent_since)
+
+        self.uncue()
+        self.current_source = None
+        self.activity.change_act(MusicActivity.Status.STOPPED, None)
+        await Music.destroy_player(self.guild_id)
+
+    async def open_audio(self, source):
+        """Waits for a song to be streamable or downloaded, then starts FFmpeg on it.
+        Its BufferedAudio starts filling right away, so the first frames are ready by the time it plays."""
+        audio_input, before_options = await source.audio_input(self.bot.loop)
+        if source.start_at:  # Resuming where we left off before a restart
+            before_options = f'-ss {source.start_at:.2f} {before_options or ""}'.strip()
+        return MeteredAudio(create_audio(audio_input, before_options, source.data, self.volume,
+                                         cfload.settings.music.opus_passthrough, cfload.settings.music.buffer_ms // 20))
+
+    def cue(self, source):
+        """Opens the next song and cues it on the deck, so it starts the moment the current one ends."""
+        if self.cue_source is source:
             return
-
-        self.current_source = self.queue.popleft()
-        # PCMVolumeTransformer allows the volume to be changed.
-        self.audio_streamer = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(self.current_source.path), volume=self.volume)
-        # Play the audio. This has a recursive call to pop the next song until the queue is empty.
-        self.vc.play(self.audio_streamer, after=lambda e: self.music_loop(ctx))
-        log.debug('Now playing', self.current_source.data['title'])
-
-        self.bot.loop.create_task(self.activity.change_act(MusicActivity.Status.PLAYING, self.current_source))
+        self.uncue()
+        self.cue_source = source
+        self.cue_task = self.bot.loop.create_task(self.open_cued(source))
+
+    async def open_cued(self, source):
+        audio = await self.open_audio(source)
+        if self.deck is not None:
+            self.deck.cue(audio, source)  # Nothing else is cued, uncue saw to that
+        return audio
+
+    def uncue(self):
+        """Stops the cued song from playing next (the queue changed) and kills its FFmpeg."""
+        task = self.cue_task
+        if task is None:
+            return
+        task.cancel()
+        self.cue_source = self.cue_task = None
+        old = self.deck.cue(None, None) if self.deck is not None else None
+        if not old and task.done() and not task.cancelled() and task.exception() is None:
+            old = task.result()  # Opened after the deck stopped
+        if old and old is not self.audio_streamer and (self.deck is None or old is not self.deck.current):
+            self.bot.loop.run_in_executor(None, old.cleanup)
+
+    def deck_switched(self, old, new, source, gap):
+        """Called by the deck on the audio thread when it moves on to the cued song."""
+        self.bot.loop.call_soon_threadsafe(self.switched, old, new, source, gap)
+
+    def switched(self, old, new, source, gap):
+        self.switched_to = (source, new)
+        self.cue_source = self.cue_task = None
+        self.gaps.append(gap)
+        self.song_ended.set()
+        self.bot.loop.run_in_executor(None, old.cleanup)  # Waits for FFmpeg to exit
+
+    def after_song(self, error):
+        """Called by discord.py on the audio thread when a song ends."""
+        self.ended_at = time.perf_counter()
+        if error is not None:
+            self.bot.loop.call_soon_threadsafe(log.error, 'Player error:', error)
+        self.bot.loop.call_soon_threadsafe(self.song_ended.set)
+
+    async def prebuffer(self, duration):
+        """Starts loading the next song prebuffer_seconds before the current one ends."""
+        if duration:
+            await asyncio.sleep(max(0, duration - cfload.settings.music.prebuffer_seconds))
+        self.prebuffering = True
+        self.load_next()
+
+    def resolve_ahead(self):
+        """Resolves the songs within lookahead positions of the front of the queue, in parallel."""
+        for i, source in enumerate(self.queue):
+            if i >= cfload.settings.music.lookahead:
+                break
+            if source.download_task is None:  # Songs in the music cache don't need a media URL
+                source.resolve(self.bot.loop)
+
+    def load_next(self):
+        """Starts downloading the next song, if the current one is about to end."""
+        next_source = self.queue.peek()
+        if not self.prebuffering or next_source is None:
+            return
+        if not next_source.resolved:  # Can't tell if it's streamable yet, so check again once it is
+            next_source.resolve(self.bot.loop).add_done_callback(self.resolved_next)
+            return
+        if not next_source.streamable:
+            next_source.prefetch(self.bot.loop)
+        if cfload.settings.music.gapless:
+            self.cue(next_source)
+
+    def resolved_next(self, task):
+        if not task.cancelled() and task.exception() is None:
+            self.load_next()
+
+    def position(self):
+        """Seconds into the current song."""
+        if self.current_source is None or self.audio_streamer is None:
+            return 0.
+        return self.current_source.start_at + self.audio_streamer.played()
+
+    def buffer_stats(self):
+        """Returns (underruns since the player started, fill level 0-1 of the current song's buffer or None)."""
+        buffer = self.audio_streamer.buffer if self.audio_streamer is not None else None
+        if buffer is None:
+            return self.underruns, None
+        return self.underruns + buffer.underruns, buffer.fill_level()
+
+    def idle(self):
+        """Seconds since the player last did anything, or 0 if it's playing."""
+        if self.vc is not None and self.vc.is_playing():
+            return 0.
+        return time.monotonic() - self.last_active
+
+    def memory(self):
+        """Roughly how many bytes the player's songs take up."""
+        sources = list(self.queue) + ([self.current_source] if self.current_source is not None else [])
+        return sum(source.memory() for source in sources)
+
+    def snapshot(self):
+        """Returns the player's state (voice channel, volume, songs) for Music.save_state."""
+        tracks = [source.snapshot() for source in self.queue]
+        if self.current_source is not None:
+            tracks.insert(0, self.current_source.snapshot(self.position()))
+        return {'channel_id': self.vc.channel.id, 'volume': self.volume, 'tracks': tracks}
+
+    def average_gap(self):
+        return sum(self.gaps) / len(self.gaps) if self.gaps else None
+
+    def set_volume(self, volume):
+        """Sets the volume (0-1). Passthrough Opus streams pick it up when the next song starts."""
+        self.volume = volume
+        for audio in (self.audio_streamer, self.deck.upcoming if self.deck is not None else None):
+            if audio is not None and isinstance(audio.original, discord.PCMVolumeTransformer):
+                audio.original.volume = volume
+
+    def skip(self):
+        """Moves on to the next song, straight away if it's cued."""
+        if self.deck is not None and self.vc.is_playing():
+            self.deck.skip()
+        else:  # Paused, or not playing through a deck
+            self.vc.stop()
 
 
 class Music(commands.Cog):
@@ -105,9 +531,97 @@ class Music(commands.Cog):
 
     # Represents guild-specific music clients.
     players = {}
+    # Shared by every player, since the bot only has one presence.
+    presence = None
+
+    # What's playing is saved here when the cog is unloaded (reloads and shutdowns) and picked up again when it loads.
+    state_path = '../cache/music_state.json'
+    if 'ALFRED_WORKER' in os.environ:  # One file per launcher.py worker, like the logs
+        state_path = f'../cache/music_state-worker{os.environ["ALFRED_WORKER"]}.json'
+    state_max_age = 600  # Older snapshots are ignored, nobody wants last week's queue
+    restore_stagger = .5  # Seconds between voice reconnects while restoring, so they don't all happen at once
 
     def __init__(self, bot):
         self.bot = bot
+        # Not at import time, since a failed reload puts the old module back with setup() after cog_unload
+        YTDLSource.executor = ThreadPoolExecutor(max_workers=cfload.settings.music.ytdl_workers)
+        YTDLSource.cache = MusicCache('../music_cache', cfload.settings.music.cache_size_mb * 2**20)
+        YTDLSource.queries = QueryCache('../cache/queries.db', cfload.settings.music.query_cache_days * 86400,
+                                        cfload.settings.music.query_cache_size)
+        Music.presence = PresenceScheduler(bot, Music.players)
+        cfload.listeners.append(self.on_config_reload)
+        self.bot.loop.create_task(self.restore_state())
+        self.reap.start()
+
+    def cog_unload(self):
+        self.reap.cancel()
+        self.save_state()
+        for player in Music.players.values():
+            # Keep the voice connection so the reloaded cog can pick it up
+            if player.task is not None:
+                player.task.cancel()
+            player.uncue()
+            if player.vc is not None:
+                player.vc.stop()
+        Music.players.clear()
+        Music.presence.stop()
+        YTDLSource.executor.shutdown(wait=False)
+        YTDLSource.cache.close()
+        YTDLSource.queries.close()
+        cfload.listeners.remove(self.on_config_reload)
+
+    def save_state(self):
+        """Writes every connected player's state to state_path."""
+        players = {guild_id: player.snapshot() for guild_id, player in Music.players.items()
+                   if player.vc is not None and player.vc.is_connected()}
+        if not players:
+            return
+        os.makedirs(os.path.dirname(Music.state_path), exist_ok=True)
+        tmp_path = Music.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'saved': time.time(), 'players': players}, f, separators=(',', ':'))
+        os.replace(tmp_path, Music.state_path)
+        log.info(f'Saved the state of {len(players)} music players.')
+
+    async def restore_state(self):
+        """Rebuilds the players saved by save_state, reusing voice connections that survived a reload."""
+        try:
+            with open(Music.state_path) as f:
+                state = json.load(f)
+            os.remove(Music.state_path)
+        except (OSError, ValueError):
+            return
+        if time.time() - state['saved'] > Music.state_max_age:
+            return
+
+        await self.bot.wait_until_ready()
+        restored = 0
+        for guild_id, saved in state['players'].items():
+            guild = self.bot.get_guild(int(guild_id))
+            channel = guild.get_channel(saved['channel_id']) if guild is not None else None
+            if channel is None or not saved['tracks'] or guild.id in Music.players:
+                continue
+            player = MusicPlayer(self.bot, guild.id, guild.shard_id)
+            player.volume = saved['volume']
+            try:
+                player.vc = guild.voice_client
+                if player.vc is None:
+                    player.vc = await channel.connect()
+                    await asyncio.sleep(Music.restore_stagger)
+            except Exception as e:
+                log.error('Failed to reconnect:', e, guild_id=guild.id)
+                continue
+            for track in saved['tracks'][:player.queue.maxsize or None]:
+                player.queue.put_nowait(YTDLSource.restore(track))
+            Music.players[guild.id] = player
+            player.resolve_ahead()
+            player.start()
+            restored += 1
+        log.info(f'Restored {restored} music players.')
+
+    def on_config_reload(self, settings):
+        YTDLSource.cache.max_bytes = settings.music.cache_size_mb * 2**20
+        self.bot.loop.run_in_executor(YTDLSource.cache.db_executor, YTDLSource.cache.evict)
 
     def get_player(self, ctx):
         """Gets a guild's music player.
@@ -115,19 +629,42 @@ class Music(commands.Cog):
         try:
             player = Music.players[ctx.guild.id]
         except KeyError:
-            player = MusicPlayer(self.bot, ctx.guild.id)
+            player = MusicPlayer(self.bot, ctx.guild.id, ctx.guild.shard_id)
             Music.players[ctx.guild.id] = player
-            log.debug('Created new MusicPlayer for guild', str(ctx.guild.id))
+            log.debug('Created new MusicPlayer.', ctx=ctx)
+        player.last_active = time.monotonic()
+        return player
+
+    def find_player(self, ctx):
+        """Gets a guild's music player, or None if it doesn't have one.
+        For commands that don't start playing anything, so they don't leave a player behind."""
+        player = Music.players.get(ctx.guild.id)
+        if player is not None:
+            player.last_active = time.monotonic()
         return player
 
+    @tasks.loop(minutes=1)
+    async def reap(self):
+        """Disconnects and frees players that haven't played anything or been used in [Music] idle_minutes."""
+        for guild_id, player in list(Music.players.items()):
+            if player.idle() > cfload.settings.music.idle_minutes * 60:
+                log.debug('Player idle, disconnecting.', guild_id=guild_id)
+                await Music.destroy_player(guild_id)
+
     @classmethod
     async def destroy_player(cls, guild_id):
         """Destroys a guild's player. Disconnects from the channel
         and deletes the player entry in Music.players."""
-        if cls.players[guild_id].vc is not None:
-            await cls.players[guild_id].vc.disconnect()
-        del cls.players[guild_id]
-        log.debug('Destroyed', str(guild_id) + '\'s MusicPlayer.')
+        player = cls.players.pop(guild_id, None)
+        if player is None:
+            return
+        cls.presence.request()  # Stop showing its song
+        player.uncue()
+        if player.task is not None and player.task is not asyncio.current_task():
+            player.task.cancel()
+        if player.vc is not None:
+            await player.vc.disconnect()
+        log.debug('Destroyed MusicPlayer.', guild_id=guild_id)
 
     @commands.command()
     async def join(self, ctx):
@@ -140,31 +677,37 @@ class Music(commands.Cog):
         try:
             player.vc = await ctx.author.voice.channel.connect()
         except discord.errors.ClientException:
-            log.info('Player already connected.')
+            log.info('Player already connected.', ctx=ctx)
 
     @commands.command()
     async def leave(self, ctx):
         """Leave the voice channel, clear the queue."""
-        player = self.get_player(ctx)
+        player = self.find_player(ctx)
+        if player is None:
+            return await ctx.message.add_reaction("\U00002753")  # question mark
         await Music.destroy_player(player.guild_id)
-        await self.activity.change_act(MusicActivity.Status.STOPPED, None)
+        player.activity.change_act(MusicActivity.Status.STOPPED, None)
 
     @commands.command(aliases=['q'])
     async def queue(self, ctx):  # TODO add links to queues, improve embed functionality and UI
         """Displays the song queue."""
-        player = self.get_player(ctx)
+        player = self.find_player(ctx)
 
         embed = discord.Embed(title='Song Queue', colour=discord.Colour(0xe7d066))  # Yellow
-        if len(player.queue) == 0:
+        if player is None or len(player.queue) == 0:
             await ctx.send('Nothing is enqueued. Play a song with /play', delete_after=10)
         else:
             for p in player.queue:
                 embed.add_field(name=p.data['title'], value='_'*10, inline=False)
+            footer = f'{len(player.queue)}/{player.queue.maxsize} songs, {player.memory() / 1024:.1f} KB'
+            if player.average_gap() is not None:
+                footer += f'. Average gap between songs: {player.average_gap() * 1000:.0f} ms'
+            embed.set_footer(text=footer)
             await ctx.send(embed=embed)
 
     @commands.command()
     async def play(self, ctx, *query):
-        """Play a song."""
+        """Play a song. Separate several songs with | to queue them all at once."""
         await self.playsong(ctx, *query)
 
     @commands.command()
@@ -173,34 +716,83 @@ class Music(commands.Cog):
         await self.playsong(ctx, *query, up_next=True)
 
     async def playsong(self, ctx, *query, up_next=False):
-        """ Creates a YTDL source for the query, adds it to the queue, and starts the music loop. """
+        """ Creates YTDL sources for the queries, adds them to the queue, and starts the music loop. """
         player = self.get_player(ctx)
+        queries = [q.split() for q in ' '.join(query).split('|') if q.strip()]
 
         # Make sure the user actually searched something
-        if not query:
+        if not queries:
             return await ctx.message.add_reaction("\U0000274C")  # Cross mark
 
+        if player.queue.full():
+            return await ctx.send(f'The queue is full ({player.queue.maxsize} songs).', delete_after=10)
+
         await ctx.message.add_reaction("\U0000231B")  # hourglass done (not actually done)
 
         await self.joinChannel(ctx, player)
 
-        # Add the YTDLSource to the queue, either up front or in the back
-        try:
-            if up_next:
-                player.queue.appendleft(YTDLSource(query))
-            else:
-                player.queue.append(YTDLSource(query))
-        except Exception as e:
-            await ctx.message.add_reaction("\U0000274C")  # Cross mark
-            # log.error('Exception while getting the YTDLSource:', e)
-
-        if not player.vc.is_playing() and not player.vc.is_paused():
-            # Start the music loop.
-            player.music_loop(ctx)
+        # Resolve every query at once (the executor bounds how many run in parallel), but add them
+        # in order, each as soon as it and the ones before it are ready.
+        # Only the metadata is awaited here; the player task downloads songs when their turn gets close.
+        pending = [self.bot.loop.create_task(YTDLSource.create(q, self.bot.loop)) for q in queries]
+        position = 0
+        for task in pending:
+            try:
+                source = await task
+            except Exception as e:
+                await ctx.message.add_reaction("\U0000274C")  # Cross mark
+                log.error('Exception while getting the YTDLSource:', e, ctx=ctx)
+                continue
+            try:
+                if up_next:
+                    player.queue.insert_nowait(position, source)
+                    position += 1
+                else:
+                    player.queue.put_nowait(source)
+            except asyncio.QueueFull:
+                for rest in pending:
+                    rest.cancel()
+                await ctx.send(f'The queue is full ({player.queue.maxsize} songs).', delete_after=10)
+                break
+            player.load_next()  # In case the current song is already about to end
+            player.start()
 
         await ctx.message.remove_reaction("\U0000231B", ctx.me)  # hourglass done
         await ctx.message.add_reaction("\U00002705")  # white heavy check mark (green in discord)
 
+    @commands.command(aliases=['pl'])
+    async def playlist(self, ctx, url):
+        """Queue every song in a playlist."""
+        player = self.get_player(ctx)
+        await ctx.message.add_reaction("\U0000231B")  # hourglass done (not actually done)
+        await self.joinChannel(ctx, player)
+
+        try:
+            sources = await YTDLSource.playlist(url, self.bot.loop)
+        except Exception as e:
+            await ctx.message.remove_reaction("\U0000231B", ctx.me)
+            log.error('Exception while getting the playlist:', e, ctx=ctx)
+            return await ctx.message.add_reaction("\U0000274C")  # Cross mark
+
+        # Songs are only resolved when they get within lookahead positions of the front.
+        queued = 0
+        for source in sources:
+            try:
+                player.queue.put_nowait(source)
+            except asyncio.QueueFull:
+                break
+            queued += 1
+        player.resolve_ahead()
+        player.load_next()
+        player.start()
+
+        await ctx.message.remove_reaction("\U0000231B", ctx.me)
+        if queued < len(sources):
+            await ctx.send(f'Queued {queued} of {len(sources)} songs, the queue is full ({player.queue.maxsize} songs).',
+                           delete_after=10)
+        else:
+            await ctx.send(f'Queued {queued} songs.', delete_after=10)
+
     # @commands.command()
     # async def search(self, ctx, *, search : str):
     #
@@ -215,26 +807,34 @@ class Music(commands.Cog):
 
     @commands.command()
     async def pause(self, ctx):
-        player = self.get_player(ctx)
+        player = self.find_player(ctx)
+        if player is None or player.vc is None:
+            return await ctx.send('Nothing is playing.', delete_after=10)
         player.vc.pause()
         await ctx.message.add_reaction("\U000023F8")  # pause button
 
     @commands.command(aliases=["res"])
     async def resume(self, ctx):
-        player = self.get_player(ctx)
+        player = self.find_player(ctx)
+        if player is None or player.vc is None:
+            return await ctx.send('Nothing is playing.', delete_after=10)
         player.vc.resume()
         await ctx.message.add_reaction("\U000025B6")  # play button
 
     @commands.command()
     async def skip(self, ctx):
-        player = self.get_player(ctx)
-        player.vc.stop()
+        player = self.find_player(ctx)
+        if player is None or player.vc is None:
+            return await ctx.send('Nothing is playing.', delete_after=10)
+        player.skip()
         await ctx.message.add_reaction("\U000023ED")  # next track button
 
     @commands.command(aliases=["vol"])
     async def volume(self, ctx, vol=None):
-        player = self.get_player(ctx)
+        player = self.find_player(ctx)
         if vol is not None:
+            if player is None:
+                return await ctx.send('Nothing is playing.', delete_after=10)
             try:
                 # Limit the volume between 0 and 100.
                 new_vol = max(min(100., float(vol)), 0.)  # TODO do these need to be floats?
@@ -242,11 +842,31 @@ class Music(commands.Cog):
                 log.debug('Volume must be a float.')
                 return await ctx.message.add_reaction("\U00002753")  # question mark
 
-            player.volume = new_vol / 100
-            player.audio_streamer.volume = player.volume
+            player.set_volume(new_vol / 100)
             await ctx.message.add_reaction("\U00002705")  # white heavy check mark (green in Discord)
         else:
-            await ctx.send('Volume currently set to ' + str(int(player.audio_streamer.volume * 100)) + '%.', delete_after=10)
+            volume = player.volume if player is not None else MusicPlayer.default_volume
+            await ctx.send('Volume currently set to ' + str(int(volume * 100)) + '%.', delete_after=10)
+
+    @commands.command()
+    async def streams(self, ctx):
+        """Shows how much CPU each playing guild's stream costs, to see how many guilds one process can handle."""
+        embed = discord.Embed(title='Stream CPU usage', colour=discord.Colour(0xe7d066))
+        total_python, total_ffmpeg = 0., 0.
+        for guild_id, player in Music.players.items():
+            if player.audio_streamer is None or player.audio_streamer.started is None:
+                continue
+            python, ffmpeg = player.audio_streamer.usage()
+            total_python += python
+            total_ffmpeg += ffmpeg or 0.
+            mode = 'Opus' if player.audio_streamer.is_opus() else 'PCM'
+            ffmpeg = f'{ffmpeg:.1%}' if ffmpeg is not None else 'n/a'
+            underruns, fill = player.buffer_stats()
+            buffer = f', buffer {fill:.0%} full, {underruns} underruns' if fill is not None else ''
+            embed.add_field(name=str(self.bot.get_guild(guild_id) or guild_id),
+                            value=f'{mode} - Python {python:.1%}, FFmpeg {ffmpeg}{buffer}', inline=False)
+        embed.set_footer(text=f'Total: Python {total_python:.1%}, FFmpeg {total_ffmpeg:.1%} of one core')
+        await ctx.send(embed=embed)
 
 def setup(bot):
     bot.add_cog(Music(bot))
@@ -0,0 +1,159 @@
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from logger import Logger as log
+from singleflight import SingleFlight
+
+
+class MusicCache:
+    """Persistent on-disk cache of downloaded songs.
+    Keeps an index from video keys (extractor-id) to the downloaded file and its metadata
+    (which video a query means is up to QueryCache).
+    The index is kept in SQLite, so every launcher.py worker shares the same files and the same size limit.
+    Songs are evicted least-recently-used first once the cache grows past max_bytes."""
+
+    index_name = 'index.db'
+    legacy_index_name = 'index.json'  # From before the index was in SQLite, imported once
+    # Metadata worth keeping in the index. The full extract_info dict is huge.
+    kept_fields = ('id', 'extractor', 'title', 'webpage_url', 'duration', 'ext', 'acodec')
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, MusicCache.index_name)
+        # key -> path of every song known to be downloaded, so contains() doesn't have to ask the database.
+        # Other workers' downloads only show up here once fetch() looks them up.
+        self.paths = {}
+        self.downloads = SingleFlight()
+        # SQLite connections shouldn't be shared between threads, so the database only ever sees this one.
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='musiccache')
+        self.db = None
+        self.db_executor.submit(self.connect)
+
+    @staticmethod
+    def key(data):
+        return f'{data["extractor"]}-{data["id"]}'
+
+    def connect(self):
+        """Opens the index, creating it if needed, and reads which songs are downloaded. Runs on db_executor."""
+        if self.db is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.db = sqlite3.connect(self.index_path, timeout=5)
+        self.db.execute('PRAGMA journal_mode=WAL')  # Readers in other workers don't block writers
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS songs '
+                        '(key TEXT PRIMARY KEY, path TEXT, size INTEGER, last_used REAL, data TEXT)')
+        self.import_legacy()
+
+        total_bytes = 0
+        for key, path, size in self.db.execute('SELECT key, path, size FROM songs').fetchall():
+            self.paths[key] = path
+            total_bytes += size
+        log.info(f'Music cache loaded: {len(self.paths)} songs, {total_bytes // 2**20} MB.')
+
+    def import_legacy(self):
+        """Moves the entries of an old index.json into the database, so their files still get evicted."""
+        legacy_path = os.path.join(self.directory, MusicCache.legacy_index_name)
+        try:
+            with open(legacy_path) as f:
+                entries = json.load(f).get('entries', {})
+        except (OSError, ValueError):
+            return
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO songs VALUES (?, ?, ?, ?, ?)',
+                                [(key, entry['path'], entry['size'], entry['last_used'], json.dumps(entry['data']))
+                                 for key, entry in entries.items() if os.path.isfile(entry['path'])])
+        try:
+            os.remove(legacy_path)
+        except OSError:  # Another worker got there first
+            pass
+
+    def contains(self, data):
+        """Whether the song described by data is downloaded. Unresolved playlist songs never are."""
+        if 'id' not in data:
+            return False
+        path = self.paths.get(MusicCache.key(data))
+        return path is not None and os.path.isfile(path)
+
+    def lookup(self, key):
+        """Returns the path of a downloaded song and marks it as used, or None. Runs on db_executor."""
+        self.connect()
+        row = self.db.execute('SELECT path FROM songs WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.paths.pop(key, None)
+            return None
+        path = row[0]
+        with self.db:
+            if not os.path.isfile(path):  # Deleted behind our back
+                self.db.execute('DELETE FROM songs WHERE key = ?', (key,))
+                self.paths.pop(key, None)
+                return None
+            self.db.execute('UPDATE songs SET last_used = ? WHERE key = ?', (time.time(), key))
+        self.paths[key] = path
+        return path
+
+    async def fetch(self, data, download, loop, executor):
+        """Returns the path of the song described by data, downloading it with download() on executor if needed.
+        Concurrent requests for the same song share a single download."""
+        key = MusicCache.key(data)
+
+        try:
+            path = await loop.run_in_executor(self.db_executor, self.lookup, key)
+        except sqlite3.Error as e:
+            log.warning('Could not read the music cache:', str(e))
+            path = None
+        if path is not None:
+            return path
+
+        async def download_and_add():
+            path = await loop.run_in_executor(executor, download)
+            self.paths[key] = path
+            try:
+                await loop.run_in_executor(self.db_executor, self.add, key, path, data)
+            except sqlite3.Error as e:  # The song still plays, it just won't be found again
+                log.warning('Could not save song to the music cache:', str(e))
+            return path
+        return await self.downloads.run(key, download_and_add, loop)
+
+    def add(self, key, path, data):
+        """Adds a downloaded song to the index, then evicts songs past max_bytes. Runs on db_executor."""
+        self.connect()
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?)',
+                            (key, path, os.path.getsize(path), time.time(),
+                             json.dumps({field: data.get(field) for field in MusicCache.kept_fields})))
+        self.evict()
+
+    def evict(self):
+        """Deletes least recently used songs until the cache fits in max_bytes. Always keeps the newest song.
+        Runs on db_executor."""
+        self.connect()
+        try:
+            with self.db:
+                total_bytes, count = self.db.execute('SELECT COALESCE(SUM(size), 0), COUNT(*) FROM songs').fetchone()
+                songs = self.db.execute('SELECT key, path, size FROM songs ORDER BY last_used').fetchall()
+                for key, path, size in songs:
+                    if total_bytes <= self.max_bytes or count <= 1:
+                        break
+                    self.db.execute('DELETE FROM songs WHERE key = ?', (key,))
+                    self.paths.pop(key, None)
+                    total_bytes -= size
+                    count -= 1
+                    try:
+                        os.remove(path)
+                    except OSError as e:  # Probably still open on Windows
+                        log.warning('Could not evict', path, str(e))
+                    log.debug('Evicted', key, 'from the music cache.')
+        except sqlite3.Error as e:  # Another worker is evicting, it'll do
+            log.warning('Could not evict from the music cache:', str(e))
+
+    def close(self):
+        def close_db():
+            if self.db is not None:
+                self.db.close()
+        self.db_executor.submit(close_db)
+        self.db_executor.shutdown(wait=False)
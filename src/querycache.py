@@ -0,0 +1,168 @@
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+from logger import Logger as log
+from musiccache import MusicCache
+from singleflight import SingleFlight
+
+
+class QueryCache:
+    """Remembers which video a /play query resolved to, and that video's trimmed metadata, so a repeated query
+    (from any guild, even after a restart) skips youtube_dl entirely.
+
+    The most recently used queries are kept in memory, and everything is kept in SQLite, which every launcher.py
+    worker shares. Query results are trusted for ttl seconds. Media URLs expire much sooner (YouTube signs them for
+    a few hours), so an entry whose URL has expired still answers for the metadata, but without the URL.
+    Concurrent lookups of the same query share a single extraction."""
+
+    # Media URLs are treated as expired this many seconds (plus the song's duration) early,
+    # so they don't run out halfway through a song.
+    url_margin = 60
+    # For URLs without an expire parameter
+    default_url_seconds = 3600
+
+    def __init__(self, path, ttl, memory_size):
+        self.path = path
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.queries = OrderedDict()  # normalized query -> video key, least recently used first
+        self.videos = OrderedDict()  # video key -> (resolved_at, url_expires, data)
+        self.extractions = SingleFlight()  # By normalized query
+        # SQLite connections shouldn't be shared between threads, so the database only ever sees this one.
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='querycache')
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query):
+        if '://' in query:  # Video IDs are case-sensitive
+            return query.strip()
+        return ' '.join(query.lower().split())
+
+    @staticmethod
+    def url_expires(data, resolved_at):
+        """When the media URL in data stops working, from its expire parameter if it has one."""
+        url = data.get('url')
+        if not url:
+            return 0.
+        expire = parse_qs(urlparse(url).query).get('expire')
+        try:
+            return float(expire[0])
+        except (TypeError, ValueError):
+            return resolved_at + QueryCache.default_url_seconds
+
+    def connect(self):
+        """Opens the database, creating it if needed, and drops entries older than ttl. Runs on db_executor."""
+        if self.db is not None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=5)
+        self.db.execute('PRAGMA journal_mode=WAL')  # Readers in other workers don't block writers
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS queries (query TEXT PRIMARY KEY, key TEXT, resolved_at REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS videos '
+                        '(key TEXT PRIMARY KEY, data TEXT, resolved_at REAL, url_expires REAL)')
+        with self.db:
+            cutoff = time.time() - self.ttl
+            self.db.execute('DELETE FROM queries WHERE resolved_at < ?', (cutoff,))
+            self.db.execute('DELETE FROM videos WHERE resolved_at < ? AND key NOT IN (SELECT key FROM queries)',
+                            (cutoff,))
+
+    def read(self, query):
+        """Looks up a normalized query in SQLite. Returns (key, (resolved_at, url_expires, data)) or None."""
+        self.connect()
+        row = self.db.execute('SELECT videos.key, videos.resolved_at, url_expires, data FROM queries '
+                              'JOIN videos ON queries.key = videos.key WHERE query = ? AND queries.resolved_at > ?',
+                              (query, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        key, resolved_at, url_expires, data = row
+        return key, (resolved_at, url_expires, json.loads(data))
+
+    def write(self, queries, key, video):
+        self.connect()
+        resolved_at, url_expires, data = video
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO queries VALUES (?, ?, ?)',
+                                [(query, key, resolved_at) for query in queries])
+            self.db.execute('INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?)',
+                            (key, json.dumps(data, separators=(',', ':')), resolved_at, url_expires))
+
+    def remember(self, query, key, video):
+        """Adds to the memory tier, dropping the least recently used queries past memory_size."""
+        self.queries[query] = key
+        self.queries.move_to_end(query)
+        self.videos[key] = video
+        self.videos.move_to_end(key)
+        while len(self.queries) > self.memory_size:
+            self.queries.popitem(last=False)
+        while len(self.videos) > self.memory_size:
+            self.videos.popitem(last=False)
+
+    async def get(self, query, loop, need_url=False):
+        """Returns the cached metadata for a normalized query, or None on a miss.
+        The media URL is left out if it has expired, or counts as a miss with need_url."""
+        key = self.queries.get(query)
+        video = self.videos.get(key)
+        if video is None:
+            try:
+                found = await loop.run_in_executor(self.db_executor, self.read, query)
+            except sqlite3.Error as e:
+                log.warning('Could not read the query cache:', str(e))
+                found = None
+            if found is None:
+                return None
+            key, video = found
+        resolved_at, url_expires, data = video
+        if time.time() - resolved_at > self.ttl:
+            return None
+        self.remember(query, key, video)
+        if url_expires - time.time() < QueryCache.url_margin + (data.get('duration') or 0):
+            if need_url:
+                return None
+            data = {field: value for field, value in data.items() if field != 'url'}
+        return data
+
+    async def resolve(self, query, extract, loop, executor, need_url=False):
+        """Returns the metadata for query, calling extract(query) on executor if it isn't cached.
+        extract has to return a dict with at least extractor, id and webpage_url. Concurrent misses for the same
+        query share one extraction. The result is also cached under its webpage_url, so refreshing an expired
+        URL through it updates every query that resolved to that video."""
+        normalized = QueryCache.normalize(query)
+        data = await self.get(normalized, loop, need_url)
+        if data is not None:
+            self.hits += 1
+            return data
+
+        async def extract_and_save():
+            self.misses += 1
+            data = await loop.run_in_executor(executor, extract, query)
+            return await self.save(normalized, data, loop)
+        return await self.extractions.run(normalized, extract_and_save, loop)
+
+    async def save(self, normalized, data, loop):
+        """Caches freshly extracted metadata under the query and its webpage_url. Returns data."""
+        resolved_at = time.time()
+        video = (resolved_at, QueryCache.url_expires(data, resolved_at), data)
+        key = MusicCache.key(data)  # Same keys as the song cache
+        queries = {normalized, QueryCache.normalize(data['webpage_url'])}
+        for q in queries:
+            self.remember(q, key, video)
+        try:
+            await loop.run_in_executor(self.db_executor, self.write, queries, key, video)
+        except sqlite3.Error as e:  # Still works from memory
+            log.warning('Could not save query to the cache:', str(e))
+        return data
+
+    def close(self):
+        def close_db():
+            if self.db is not None:
+                self.db.close()
+        self.db_executor.submit(close_db)
+        self.db_executor.shutdown(wait=False)
@@ -0,0 +1,34 @@
+import time
+from urllib.parse import urlsplit
+
+import praw
+import prawcore
+
+
+class MeteredRequestor(prawcore.Requestor):
+    """Times PRAW's requests, so Reddit shows up next to the other upstreams in bot.web.latency."""
+
+    def __init__(self, *args, latency=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency = latency
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        error = True
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            error = response.status_code >= 400
+            return response
+        finally:
+            self.latency[urlsplit(url).hostname].observe(time.perf_counter() - start, error=error)
+
+
+def connect(credentials, latency):
+    """Creates the Reddit client from the [Reddit API] settings."""
+    return praw.Reddit(client_id=credentials.client_id,
+                       client_secret=credentials.client_secret,
+                       user_agent=credentials.user_agent,
+                       username=credentials.username,
+                       password=credentials.password,
+                       requestor_class=MeteredRequestor,
+                       requestor_kwargs={'latency': latency})
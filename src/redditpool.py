@@ -0,0 +1,104 @@
+import asyncio
+import random
+import threading
+import time
+
+from logger import Logger as log
+
+
+class RedditPool:
+    """Per-subreddit pools of hot post metadata, filled in the background with one long-lived Reddit client.
+    Picking a post is a random choice from memory, so it never waits on Reddit unless a subreddit is brand new.
+    Posts aren't removed when picked, so a burst of requests can't empty a pool; refresh_loop keeps them fresh.
+    The client is created by connect() on the first fetch, off the event loop."""
+
+    def __init__(self, connect, loop, size=100, refresh_interval=600, idle_timeout=86400):
+        self.connect = connect
+        self.reddit = None
+        self.connect_lock = threading.Lock()
+        self.loop = loop
+        self.size = size  # Posts fetched per subreddit
+        self.refresh_interval = refresh_interval
+        self.idle_timeout = idle_timeout  # Stop refreshing subreddits nobody asked for in this long
+        self.pools = {}  # subreddit -> list of posts
+        self.nsfw = set()
+        self.last_used = {}  # subreddit -> time
+        self.pending = {}  # subreddit -> Future, so a subreddit is only fetched once at a time
+        self.task = None
+
+    def start(self, *subreddits):
+        """Starts refreshing in the background, prefilling the given subreddits."""
+        for name in subreddits:
+            self.last_used[name.lower()] = time.time()
+            self.loop.create_task(self.fill(name.lower()))
+        self.task = self.loop.create_task(self.refresh_loop())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def pick(self, subreddit):
+        """Returns a random post from subreddit.
+        Returns None for NSFW subreddits, raises LookupError if the subreddit has no posts."""
+        name = subreddit.lower()
+        self.last_used[name] = time.time()
+        if not self.pools.get(name) and name not in self.nsfw:
+            await self.fill(name)
+        if name in self.nsfw:
+            return None
+
+        pool = self.pools.get(name)
+        if not pool:
+            raise LookupError(f'r/{subreddit} has no posts.')
+        return random.choice(pool)
+
+    async def fill(self, name):
+        if name in self.pending:
+            return await asyncio.shield(self.pending[name])
+        future = self.loop.run_in_executor(None, self.fetch, name)
+        self.pending[name] = future
+        try:
+            posts = await future
+        finally:
+            del self.pending[name]
+
+        if posts is None:
+            self.nsfw.add(name)
+            self.pools.pop(name, None)
+        else:
+            self.pools[name] = posts
+            log.debug(f'Fetched {len(posts)} posts from r/{name}.')
+
+    def fetch(self, name):
+        """Gets metadata for the hot posts in a subreddit, or None if it's NSFW. Blocking.
+        Only uses attributes that come with the listing, so there's one request per 100 posts."""
+        with self.connect_lock:
+            if self.reddit is None:
+                self.reddit = self.connect()
+        sub = self.reddit.subreddit(name)
+        if sub.over18:
+            return None
+        return [{
+            'title': post.title,
+            'permalink': post.permalink,
+            'url': post.url,
+            'author': str(post.author) if post.author is not None else '[deleted]',
+            'selftext': post.selftext[:1021] + '...' if len(post.selftext) > 1024 else post.selftext,
+            'score': post.score,
+            'num_comments': post.num_comments,
+            'subreddit': str(post.subreddit),
+        } for post in sub.hot(limit=self.size) if not post.stickied]
+
+    async def refresh_loop(self):
+        """Periodically replaces every pool with fresh posts, and forgets subreddits nobody uses anymore."""
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            now = time.time()
+            for name in list(self.pools):
+                if now - self.last_used.get(name, 0) > self.idle_timeout:
+                    del self.pools[name]
+                    continue
+                try:
+                    await self.fill(name)
+                except Exception as e:
+                    log.warning(f'Failed to refresh r/{name}:', str(e))
@@ -0,0 +1,39 @@
+import asyncio
+
+
+class SingleFlight:
+    """Lets concurrent requests for the same thing (a download, an extraction...) share one call.
+
+    The first caller for a key does the work, and everyone who asks for that key meanwhile waits for its result
+    (or its exception). Waiters are shielded from each other: a waiter being cancelled doesn't cancel the work,
+    and if the caller doing the work is cancelled, the next waiter starts over instead of failing with it."""
+
+    def __init__(self):
+        self.pending = {}  # key -> Future for work in progress
+
+    async def run(self, key, work, loop):
+        """Returns the result of await work(), or of the call already in progress for key."""
+        while key in self.pending:
+            future = self.pending[key]
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():  # We were cancelled ourselves
+                    raise
+                # Otherwise whoever started it was cancelled, so start over
+
+        future = loop.create_future()
+        self.pending[key] = future
+        try:
+            result = await work()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark as retrieved in case nobody else was waiting
+            raise
+        except BaseException:  # Cancelled, so let the others know instead of leaving them waiting
+            future.cancel()
+            raise
+        finally:
+            del self.pending[key]
@@ -0,0 +1,167 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict, deque
+
+import configloader as cfload
+import discord
+from audio import BufferedAudio
+from checks import owner_only
+from discord.ext import commands, tasks
+from logger import Logger as log
+from metrics import Histogram
+
+
+class LoopMonitor:
+    """Measures how late the event loop runs, and catches whatever is blocking it.
+
+    A task on the loop records a heartbeat every interval. A watchdog thread checks the heartbeat, and when it's
+    more than [Stats] lag_threshold_ms late, it grabs the loop thread's stack so we can see what's blocking it."""
+
+    interval = .1
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.lag = Histogram()
+        self.blocks = deque(maxlen=10)  # (when, seconds, stack) of recent blocking callbacks
+        self.block_count = 0
+        self.beat = time.perf_counter()
+        self.stack = None  # Stack of the callback blocking the loop right now, if any
+        self.loop_thread = None
+        self.task = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.task = self.loop.create_task(self.heartbeat())
+        threading.Thread(target=self.watchdog, name='loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def heartbeat(self):
+        self.loop_thread = threading.get_ident()
+        while True:
+            self.beat = time.perf_counter()
+            await asyncio.sleep(LoopMonitor.interval)
+            late = time.perf_counter() - self.beat - LoopMonitor.interval
+            self.lag.observe(max(late, 0.))
+            if self.stack is not None:
+                self.blocks.append((time.time(), late, self.stack))
+                self.block_count += 1
+                log.warning(f'Event loop was blocked for {late * 1000:.0f} ms at:\n{self.stack}')
+                self.stack = None
+
+    def watchdog(self):
+        while not self.stopped.wait(LoopMonitor.interval / 2):
+            threshold = cfload.settings.stats.lag_threshold_ms / 1000
+            if self.stack is not None or time.perf_counter() - self.beat < LoopMonitor.interval + threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is not None:
+                self.stack = ''.join(traceback.format_stack(frame))
+
+
+class Stats(commands.Cog):
+    """Command latency, event loop health and music counters, for the owner and for Prometheus."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.latency = defaultdict(Histogram)  # Command name -> latency
+        self.monitor = LoopMonitor(bot.loop)
+        self.monitor.start()
+        self.dump.start()
+
+    def cog_unload(self):
+        self.monitor.stop()
+        self.dump.cancel()
+
+    @commands.Cog.listener()
+    async def on_command(self, ctx):
+        ctx.started_at = time.perf_counter()
+
+    @commands.Cog.listener()
+    async def on_command_completion(self, ctx):
+        self.observe(ctx, error=False)
+
+    @commands.Cog.listener()
+    async def on_command_error(self, ctx, error):
+        self.observe(ctx, error=True)
+        # Listening for this turns off discord.py's default handler, so log what it would have printed
+        if hasattr(ctx.command, 'on_error'):
+            return
+        if ctx.cog is not None and commands.Cog._get_overridden_method(ctx.cog.cog_command_error) is not None:
+            return
+        trace = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+        log.error(f'Ignoring exception in command {ctx.command}:\n{trace}', ctx=ctx)
+
+    def observe(self, ctx, error):
+        started_at = getattr(ctx, 'started_at', None)
+        if started_at is not None and ctx.command is not None:  # Unknown commands never start
+            self.latency[ctx.command.qualified_name].observe(time.perf_counter() - started_at, error=error)
+
+    def music_counts(self):
+        """Returns the number of players, queued tracks and roughly how many bytes they use in this process."""
+        music = self.bot.get_cog('Music')
+        players = list(type(music).players.values()) if music is not None else []
+        return len(players), sum(len(player.queue) for player in players), sum(player.memory() for player in players)
+
+    @commands.command()
+    @owner_only()
+    async def stats(self, ctx):
+        """Shows command latency, event loop lag and music counters."""
+        players, queued, memory = self.music_counts()
+        embed = discord.Embed(title='Stats', colour=discord.Colour(0xe7d066))
+        embed.add_field(name='Event loop lag', value=self.monitor.lag.summary(), inline=False)
+        embed.add_field(name='Music', value=f'{len(self.bot.voice_clients)} voice clients, {players} players, '
+                                            f'{queued} queued tracks ({memory / 1024:.0f} KB)', inline=False)
+        slowest = sorted(self.latency.items(), key=lambda item: item[1].quantile(.99), reverse=True)
+        for name, histogram in slowest[:10]:
+            embed.add_field(name=f'/{name}', value=histogram.summary(), inline=False)
+        if self.monitor.blocks:
+            when, seconds, stack = self.monitor.blocks[-1]
+            embed.add_field(name=f'Last block: {seconds * 1000:.0f} ms, {time.time() - when:.0f} s ago',
+                            value=f'```{stack[-1000:]}```', inline=False)
+        await ctx.send(embed=embed)
+
+    def prometheus(self):
+        """Everything in the Prometheus text format."""
+        players, queued, memory = self.music_counts()
+        lines = ['# TYPE alfred_voice_clients gauge', f'alfred_voice_clients {len(self.bot.voice_clients)}',
+                 '# TYPE alfred_music_players gauge', f'alfred_music_players {players}',
+                 '# TYPE alfred_queued_tracks gauge', f'alfred_queued_tracks {queued}',
+                 '# TYPE alfred_music_memory_bytes gauge', f'alfred_music_memory_bytes {memory}',
+                 '# TYPE alfred_audio_underruns_total counter',
+                 f'alfred_audio_underruns_total {BufferedAudio.underruns_total}',
+                 '# TYPE alfred_loop_blocks_total counter', f'alfred_loop_blocks_total {self.monitor.block_count}',
+                 '# TYPE alfred_loop_lag_seconds histogram']
+        lines += self.monitor.lag.prometheus('alfred_loop_lag_seconds')
+        lines.append('# TYPE alfred_command_seconds histogram')
+        for name, histogram in sorted(self.latency.items()):
+            lines += histogram.prometheus('alfred_command_seconds', f'command="{name}"')
+        lines.append('# TYPE alfred_upstream_seconds histogram')
+        for host, histogram in sorted(self.bot.web.latency.items()):
+            lines += histogram.prometheus('alfred_upstream_seconds', f'host="{host}"')
+        return '\n'.join(lines) + '\n'
+
+    @tasks.loop(seconds=15)
+    async def dump(self):
+        """Writes the metrics to [Stats] dump_path for Prometheus' textfile collector."""
+        path = cfload.settings.stats.dump_path
+        if not path:
+            return
+        if self.bot.worker is not None:  # One file per launcher.py worker
+            path = path.replace('.prom', f'-worker{self.bot.worker}.prom')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+def setup(bot):
+    bot.add_cog(Stats(bot))
@@ -0,0 +1,128 @@
+import json
+import os
+import re
+import string
+import time
+
+from logger import Logger as log
+
+try:
+    import fcntl
+except ImportError:  # Windows. Saving still merges, there's just nothing stopping two workers saving at once.
+    fcntl = None
+
+
+class Trigger:
+    """Something the bot does when a message contains one of a set of words, like waving at greetings."""
+
+    __slots__ = ('name', 'words', 'action', 'hits', 'seconds')
+
+    def __init__(self, name, words, action):
+        self.name = name
+        self.words = words
+        self.action = action  # async action(message)
+        self.hits = 0
+        self.seconds = 0.  # Total time spent in action
+
+
+def react(emoji):
+    """Makes a trigger action that reacts to the message."""
+    async def action(message):
+        await message.add_reaction(emoji)
+    return action
+
+
+class TriggerEngine:
+    """Checks every message against all the triggers at once.
+
+    The triggers' words are compiled into one regex with a named group per trigger, so a message is
+    scanned once no matter how many triggers there are. Most messages can't match, so before that a set
+    lookup checks whether the message contains the first word of any trigger at all. Commands and empty
+    messages are skipped right away. Servers can turn off triggers they don't want."""
+
+    separators = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
+
+    def __init__(self, path):
+        self.path = path
+        self.triggers = {}  # name -> Trigger
+        self.pattern = None
+        self.first_words = frozenset()
+        self.disabled = {}  # guild ID -> set of trigger names
+        self.messages = 0
+        self.scan_seconds = 0.
+        self.load()
+
+    def add(self, name, words, action):
+        self.triggers[name] = Trigger(name, words, action)
+        self.compile()
+
+    def compile(self):
+        # Matched against the uppercased message, which is quicker than an IGNORECASE regex
+        groups = (f'(?P<{t.name}>{"|".join(re.escape(w.upper()) for w in t.words)})' for t in self.triggers.values())
+        self.pattern = re.compile(r'\b(?:' + '|'.join(groups) + r')\b')
+        self.first_words = frozenset(w.upper().split()[0] for t in self.triggers.values() for w in t.words)
+
+    def load(self):
+        self.disabled = self.read()
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return {int(guild_id): set(names) for guild_id, names in json.load(f).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, guild_id):
+        """Writes one guild's settings. Every launcher.py worker shares the file (and only has its own guilds'
+        settings right), so it's re-read under a lock and only this guild is replaced."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)  # Released when the file is closed
+            disabled = self.read()
+            disabled[guild_id] = self.disabled.get(guild_id, set())
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({guild_id: sorted(names) for guild_id, names in disabled.items() if names}, f)
+            os.replace(tmp_path, self.path)
+
+    def set_enabled(self, guild_id, name, enabled):
+        if name not in self.triggers:
+            raise KeyError(name)
+        names = self.disabled.setdefault(guild_id, set())
+        if enabled:
+            names.discard(name)
+        else:
+            names.add(name)
+        self.save(guild_id)
+
+    def enabled(self, guild_id, name):
+        return name not in self.disabled.get(guild_id, ())
+
+    async def handle(self, message, prefix):
+        """Runs every trigger the message matches (once each)."""
+        content = message.content
+        if not content or content.startswith(prefix) or self.pattern is None:
+            return
+
+        start = time.perf_counter()
+        content = content.upper()
+        if self.first_words.isdisjoint(content.translate(TriggerEngine.separators).split()):
+            matched = ()
+        else:
+            matched = {m.lastgroup for m in self.pattern.finditer(content)}
+        self.messages += 1
+        self.scan_seconds += time.perf_counter() - start
+
+        guild_id = message.guild.id if message.guild else None
+        for name in matched:
+            if not self.enabled(guild_id, name):
+                continue
+            trigger = self.triggers[name]
+            start = time.perf_counter()
+            try:
+                await trigger.action(message)
+            except Exception as e:
+                log.error(f'Trigger {name} failed:', e, guild_id=guild_id)
+            trigger.hits += 1
+            trigger.seconds += time.perf_counter() - start
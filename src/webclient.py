@@ -0,0 +1,60 @@
+import asyncio
+import time
+from collections import defaultdict
+
+import aiohttp
+from logger import Logger as log
+from metrics import Histogram
+from yarl import URL
+
+
+class WebClient:
+    """A single aiohttp session shared by every cog (as bot.web).
+    Keeps connections alive between requests, limits connections per host,
+    retries failed requests with exponential backoff, and records latency per upstream host."""
+
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, limit_per_host=8, timeout=10, retries=2, backoff=.5):
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.latency = defaultdict(Histogram)  # host -> Histogram
+        self._session = None
+
+    @property
+    def session(self):
+        # Created lazily so it belongs to the running event loop.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def request(self, method, url, **kwargs):
+        """Sends a request and returns the response with its body already read."""
+        host = URL(url).host
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                async with self.session.request(method, url, **kwargs) as response:
+                    await response.read()
+                self.latency[host].observe(time.perf_counter() - start, error=response.status >= 400)
+                if response.status not in WebClient.retry_statuses or attempt == self.retries:
+                    response.raise_for_status()
+                    return response
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.latency[host].observe(time.perf_counter() - start, error=True)
+                if attempt == self.retries:
+                    raise
+                log.debug(f'Request to {host} failed ({type(e).__name__}), retrying...')
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def get_json(self, url, **kwargs):
+        response = await self.request('GET', url, **kwargs)
+        return await response.json(content_type=None)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()